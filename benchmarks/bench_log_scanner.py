@@ -0,0 +1,97 @@
+"""Compare the per-category regex passes LogAIParser used to run with the
+single-pass LogScanner on a synthetic multi-megabyte log.
+
+    python -m benchmarks.bench_log_scanner [size_mb]
+"""
+import random
+import re
+import sys
+import time
+from collections import defaultdict
+
+from services.log_scanner import classify, default_scanner
+
+LINES = [
+    "[{t}] INFO Player{n} joined the server from 10.0.{a}.{b}",
+    "[{t}] INFO Player{n} left the server",
+    "[{t}] WARN Can't keep up! Is the server overloaded? Running {n}ms behind",
+    "[{t}] ERROR Failed to handle packet for /10.0.{a}.{b}: java.io.IOException",
+    "[{t}] INFO Saving chunks for level 'world'/minecraft:overworld",
+    "[{t}] WARNING Player{n} moved too quickly! {a},{b}",
+    "[{t}] INFO Disconnecting Player{n}: Timed out",
+    "[{t}] ERROR Exception in server tick loop, possible crash",
+    "[{t}] INFO Player{n} issued server command: /spawn",
+    "[{t}] INFO Connection reset by peer, lag spike of {n}ms",
+]
+
+
+def make_log(size_mb):
+    rng = random.Random(42)
+    lines = []
+    size = 0
+    while size < size_mb * 1024 * 1024:
+        line = rng.choice(LINES).format(
+            t=f"12:{rng.randrange(60):02d}:{rng.randrange(60):02d}",
+            n=rng.randrange(10000), a=rng.randrange(256), b=rng.randrange(256)
+        )
+        lines.append(line)
+        size += len(line) + 1
+    return "\n".join(lines)
+
+
+def legacy_analyze_log(log_content):
+    patterns = {
+        'errors': r'(?i)(error|exception|failed|crash)',
+        'warnings': r'(?i)(warning|warn)',
+        'connections': r'(?i)(connect|disconnect|join|leave)',
+        'security': r'(?i)(hack|cheat|exploit|inject)',
+        'performance': r'(?i)(lag|timeout|slow|performance)'
+    }
+    findings = defaultdict(list)
+    for category, pattern in patterns.items():
+        for match in re.finditer(pattern, log_content):
+            start = max(0, match.start() - 50)
+            end = min(len(log_content), match.end() + 50)
+            findings[category].append(log_content[start:end].strip())
+    return findings
+
+
+def legacy_analyze_logs_doc(content):
+    log_type = None
+    if re.search(r'(?i)error|exception', content):
+        log_type = 'errors'
+    elif re.search(r'(?i)warning', content):
+        log_type = 'warnings'
+    elif re.search(r'(?i)connect|disconnect', content):
+        log_type = 'connections'
+    patterns = [p for p in ['timeout', 'crash', 'failed', 'invalid'] if re.search(p, content, re.I)]
+    return log_type, patterns
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    size_mb = float(sys.argv[1]) if len(sys.argv) > 1 else 8
+    content = make_log(size_mb)
+    scanner = default_scanner()
+    actual_mb = len(content) / 1024 / 1024
+
+    legacy, legacy_time = timed(lambda: (legacy_analyze_log(content), legacy_analyze_logs_doc(content)))
+    scanned, scan_time = timed(scanner.scan, content)
+
+    for category, contexts in legacy[0].items():
+        assert scanned.counts.get(category, 0) == len(contexts), category
+    assert classify(scanned) == legacy[1]
+
+    print(f"log size:          {actual_mb:.1f} MB")
+    print(f"legacy (6+ passes): {legacy_time:.3f}s  {actual_mb / legacy_time:.1f} MB/s")
+    print(f"LogScanner (1 pass): {scan_time:.3f}s  {actual_mb / scan_time:.1f} MB/s")
+    print(f"speedup:           {legacy_time / scan_time:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
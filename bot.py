@@ -11,6 +11,19 @@ import logging
 import sys
 from datetime import datetime
 import pathlib
+from services.database import create_database
+from services.change_streams import ChangeStreamHub
+from services.login_profiles import LoginProfileIndex
+from services.login_sketches import LoginSketches
+from services.indexes import ensure_indexes, verify_query_plans
+from services.user_stats import UserStats
+from services.user_cache import UserCache
+from services.geoip import GeoIP
+from services.vpn import VPNClient
+from services.ip_reputation import IPReputation
+from services.login_enrichment import LoginEnrichment
+from services.consumers import DeadLetterStore
+from services.sharing import SharingDetector
 
 # Configure logging for Render
 logging.basicConfig(
@@ -40,14 +53,58 @@ class MinecraftProxyBot(commands.Bot):
             help_command=None
         )
         self.start_time = datetime.utcnow()
+        self.database = None
+        self.change_streams = None
+        self.login_profiles = None
+        self.login_sketches = None
+        self.user_stats = None
+        self.user_cache = None
+        self.geoip = None
+        self.vpn = None
+        self.ip_reputation = None
+        self.login_enrichment = None
+        self.dead_letters = None
+        self.sharing = None
         
     async def setup_hook(self):
         """Called when the bot is starting up"""
         logger.info("Setting up bot...")
         
+        # GeoIP databases are memory-mapped once and shared by every cog
+        self.geoip = GeoIP()
+        self.geoip.start()
+        self.vpn = VPNClient()
+        self.ip_reputation = IPReputation()
+        self.ip_reputation.start()
+        # Cross-account HWID/IP sharing is tracked in memory from the login stream
+        self.sharing = SharingDetector()
+        
+        # One shared MongoDB pool for every cog
+        self.database = await create_database()
+        if self.database:
+            await ensure_indexes(self.database.db)
+            if os.getenv('VERIFY_QUERY_PLANS'):
+                # Refuses to start if any handler query would scan a whole collection
+                await verify_query_plans(self.database.db)
+            self.change_streams = ChangeStreamHub(self.database.db)
+            self.login_profiles = LoginProfileIndex(self.database.db)
+            self.login_sketches = LoginSketches(self.database.db)
+            self.user_stats = UserStats(self.database.db, self.change_streams)
+            self.user_cache = UserCache(self.database.db, self.change_streams)
+            self.login_enrichment = LoginEnrichment(self.database.db, self.geoip, self.ip_reputation)
+            self.dead_letters = DeadLetterStore(self.database.db)
+        
         # Load all extensions
         await self.load_extensions()
         
+        # Open one change stream per collection the cogs subscribed to
+        if self.change_streams:
+            self.change_streams.start()
+            self.user_stats.start()
+            self.user_cache.start()
+            self.login_enrichment.start()
+            self.login_sketches.start()
+        
         # Sync slash commands
         logger.info("Syncing slash commands...")
         try:
@@ -56,6 +113,26 @@ class MinecraftProxyBot(commands.Bot):
         except Exception as e:
             logger.error(f"Failed to sync commands: {e}")
     
+    async def close(self):
+        """Close the shared MongoDB client along with the bot"""
+        await super().close()
+        if self.change_streams:
+            await self.change_streams.close()
+        if self.vpn:
+            await self.vpn.close()
+        if self.login_enrichment:
+            try:
+                await self.login_enrichment.flush()
+            except Exception as e:
+                logger.error(f"Failed to write pending login enrichment: {e}")
+        if self.login_sketches:
+            try:
+                await self.login_sketches.flush_all()
+            except Exception as e:
+                logger.error(f"Failed to write pending login sketches: {e}")
+        if self.database:
+            self.database.close()
+    
     async def load_extensions(self):
         """Load all Python files from the handlers directory"""
         for handler in glob.glob('handlers/*.py'):
@@ -1,63 +1,58 @@
 import discord
 from discord.ext import commands
-import pymongo
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 import os
 import asyncio
+from services.sweeps import SweepDigest, bulk_transition
 
 load_dotenv()
 
 class ActivityTracker(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.mongo_client = pymongo.MongoClient(os.getenv('MONGO_URI'))
-        self.db = self.mongo_client['minecraft_proxy']
+        self.db = bot.database.db
         self.channel_id = int(os.getenv('DISCORD_CHANNEL_ID'))
         self.bot.loop.create_task(self.track_activity())
 
     async def track_activity(self):
         while True:
             try:
-                # Get all active users
-                active_users = self.db.users.find({"status": "active"})
-                
-                for user in active_users:
-                    # Get last login time
-                    last_login = user.get('last_login')
-                    if not last_login:
-                        continue
-                        
-                    # Check if user hasn't logged in for 7 days
-                    if datetime.utcnow() - last_login > timedelta(days=7):
-                        await self.send_inactivity_alert(user)
-                        
-                        # Update user status
-                        self.db.users.update_one(
-                            {"_id": user["_id"]},
-                            {"$set": {"status": "inactive"}}
-                        )
+                # Flip every active user who hasn't logged in for 7 days
+                cutoff = datetime.utcnow() - timedelta(days=7)
+                digest = SweepDigest()
+                batches = bulk_transition(
+                    self.db.users,
+                    {"status": "active", "last_login": {"$lt": cutoff}},
+                    {"$set": {"status": "inactive"}},
+                    {"username": 1, "last_login": 1, "license_type": 1}
+                )
+                async for batch in batches:
+                    digest.add(batch)
+
+                if digest.total:
+                    await self.send_inactivity_digest(digest)
                 
             except Exception as e:
                 print(f"Error in activity tracker: {e}")
                 
             await asyncio.sleep(3600)  # Check every hour
 
-    async def send_inactivity_alert(self, user):
+    async def send_inactivity_digest(self, digest):
         channel = self.bot.get_channel(self.channel_id)
         if not channel:
             return
 
         embed = discord.Embed(
-            title="💤 User Inactivity Alert",
+            title=f"💤 User Inactivity Alert ({digest.total} users)",
+            description=digest.lines(
+                lambda user: f"• {user.get('username', 'N/A')} ({user.get('license_type', 'N/A')}) - "
+                             f"last login {user['last_login'].strftime('%Y-%m-%d %H:%M UTC')}"
+            ),
             color=discord.Color.orange(),
             timestamp=datetime.utcnow()
         )
         
-        embed.add_field(name="Username", value=user.get('username', 'N/A'), inline=True)
-        embed.add_field(name="Last Login", value=user['last_login'].strftime("%Y-%m-%d %H:%M UTC"), inline=True)
-        embed.add_field(name="License Type", value=user.get('license_type', 'N/A'), inline=True)
-        
         await channel.send(embed=embed)
 
     @commands.command()
@@ -66,17 +61,17 @@ class ActivityTracker(commands.Cog):
         if username is None:
             username = ctx.author.name
             
-        user = self.db.users.find_one({"username": username})
+        user = await self.bot.user_cache.get(username)
         if not user:
             await ctx.send(f"❌ User {username} not found")
             return
             
         # Get login history
-        login_history = list(self.db.login_logs.find(
+        login_history = await self.db.login_logs.find(
             {"username": username},
             sort=[("timestamp", -1)],
             limit=10
-        ))
+        ).to_list(length=10)
         
         embed = discord.Embed(
             title=f"Activity Stats: {username}",
@@ -2,9 +2,7 @@ import discord
 from discord import app_commands
 from discord.ext import commands
 from datetime import datetime
-import pymongo
 from dotenv import load_dotenv
-import os
 import logging
 
 load_dotenv()
@@ -13,38 +11,35 @@ logger = logging.getLogger('commands')
 class Commands(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.mongo_client = None
-        self.db = None
-        self.setup_mongodb()
+        self.database = bot.database
+        self.db = bot.database.db if bot.database else None
 
-    def setup_mongodb(self):
-        """Setup MongoDB connection with error handling"""
-        try:
-            mongo_uri = os.getenv('MONGO_URI')
-            if not mongo_uri:
-                logger.warning("MONGO_URI not found in environment variables")
-                return
-            
-            self.mongo_client = pymongo.MongoClient(mongo_uri, serverSelectionTimeoutMS=5000)
-            # Test the connection
-            self.mongo_client.admin.command('ping')
-            self.db = self.mongo_client['minecraft_proxy']
-            logger.info("MongoDB connection established successfully")
-        except Exception as e:
-            logger.error(f"Failed to connect to MongoDB: {e}")
-            self.mongo_client = None
-            self.db = None
-
-    def check_mongodb(self):
+    async def check_mongodb(self):
         """Check if MongoDB is available"""
-        if not self.db:
-            return False
-        try:
-            self.mongo_client.admin.command('ping')
-            return True
-        except Exception as e:
-            logger.error(f"MongoDB connection lost: {e}")
+        if self.database is None:
             return False
+        return await self.database.ping()
+
+    async def find_user(self, username):
+        """(available, user); cache hits skip the MongoDB ping, only misses need it"""
+        if self.bot.user_cache is None:
+            return False, None
+        hit, user = self.bot.user_cache.cached(username)
+        if hit:
+            return True, user
+        if not await self.check_mongodb():
+            return False, None
+        return True, await self.bot.user_cache.get(username)
+
+    def db_stats_embed(self, stats):
+        """Build the statistics embed from a UserStats snapshot"""
+        embed = discord.Embed(title="📊 Database Statistics", color=0x0099ff)
+        embed.add_field(name="Total Users", value=stats['total'], inline=True)
+        embed.add_field(name="Active Users", value=stats['active'], inline=True)
+        embed.add_field(name="Banned Users", value=stats['banned'], inline=True)
+        embed.add_field(name="Expired Users", value=stats['expired'], inline=True)
+        embed.add_field(name="Inactive Users", value=stats['inactive'], inline=True)
+        return embed
 
     # Prefix commands (legacy support)
     @commands.command()
@@ -63,19 +58,12 @@ class Commands(commands.Cog):
     @commands.has_permissions(administrator=True)
     async def db_stats(self, ctx):
         """Show database statistics"""
-        if not self.check_mongodb():
+        if self.bot.user_stats is None:
             await ctx.send("❌ Database connection not available")
             return
         
         try:
-            users = self.db.users.count_documents({})
-            active = self.db.users.count_documents({"status": "active"})
-            banned = self.db.users.count_documents({"status": "banned"})
-            
-            embed = discord.Embed(title="📊 Database Statistics", color=0x0099ff)
-            embed.add_field(name="Total Users", value=users, inline=True)
-            embed.add_field(name="Active Users", value=active, inline=True)
-            embed.add_field(name="Banned Users", value=banned, inline=True)
+            embed = self.db_stats_embed(await self.bot.user_stats.get())
             embed.set_footer(text=f"Requested by {ctx.author.name}")
             await ctx.send(embed=embed)
         except Exception as e:
@@ -86,15 +74,16 @@ class Commands(commands.Cog):
     @commands.has_permissions(administrator=True)
     async def ban(self, ctx, username: str, *, reason: str = "No reason provided"):
         """Ban a user from the proxy"""
-        if not self.check_mongodb():
+        if not await self.check_mongodb():
             await ctx.send("❌ Database connection not available")
             return
         
         try:
-            result = self.db.users.update_one(
+            result = await self.db.users.update_one(
                 {"username": username},
                 {"$set": {"status": "banned", "ban_reason": reason, "banned_at": datetime.utcnow()}}
             )
+            self.bot.user_cache.invalidate(username)
             
             if result.modified_count > 0:
                 embed = discord.Embed(
@@ -112,17 +101,65 @@ class Commands(commands.Cog):
             await ctx.send("❌ Error banning user")
 
     @commands.command()
-    async def info(self, ctx, username: str = None):
-        """Get information about a user or yourself"""
-        if not self.check_mongodb():
+    @commands.has_permissions(administrator=True)
+    async def dead_letters(self, ctx):
+        """Show events that failed processing, per consumer"""
+        if self.bot.dead_letters is None:
             await ctx.send("❌ Database connection not available")
             return
-        
+
         try:
-            if username is None:
-                username = ctx.author.name
-                
-            user = self.db.users.find_one({"username": username})
+            counts = await self.bot.dead_letters.counts()
+            embed = discord.Embed(title="📭 Dead Letters", color=0x0099ff)
+            if counts:
+                for consumer, count in sorted(counts.items()):
+                    embed.add_field(name=consumer, value=count, inline=True)
+            else:
+                embed.description = "No failed events"
+            embed.set_footer(text=f"Requested by {ctx.author.name}")
+            await ctx.send(embed=embed)
+        except Exception as e:
+            logger.error(f"Error in dead_letters command: {e}")
+            await ctx.send("❌ Error fetching dead letters")
+
+    @commands.command()
+    @commands.has_permissions(administrator=True)
+    async def replay_dead_letters(self, ctx, consumer: str = None, limit: int = 1000):
+        """Replay failed events through their handlers, oldest first"""
+        if self.bot.dead_letters is None:
+            await ctx.send("❌ Database connection not available")
+            return
+
+        if consumer and consumer not in self.bot.dead_letters.handlers:
+            known = ", ".join(sorted(self.bot.dead_letters.handlers))
+            await ctx.send(f"❌ Unknown consumer **{consumer}** (known: {known})")
+            return
+
+        try:
+            replayed, failed = await self.bot.dead_letters.replay(consumer, limit=limit)
+            embed = discord.Embed(
+                title="🔁 Dead Letters Replayed",
+                color=0x00ff00 if not failed else 0xffa500
+            )
+            embed.add_field(name="Replayed", value=replayed, inline=True)
+            embed.add_field(name="Still Failing", value=failed, inline=True)
+            embed.set_footer(text=f"Requested by {ctx.author.name}")
+            await ctx.send(embed=embed)
+        except Exception as e:
+            logger.error(f"Error in replay_dead_letters command: {e}")
+            await ctx.send("❌ Error replaying dead letters")
+
+    @commands.command()
+    async def info(self, ctx, username: str = None):
+        """Get information about a user or yourself"""
+        if username is None:
+            username = ctx.author.name
+
+        try:
+            available, user = await self.find_user(username)
+            if not available:
+                await ctx.send("❌ Database connection not available")
+                return
             if not user:
                 await ctx.send(f"❌ User **{username}** not found")
                 return
@@ -162,21 +199,14 @@ class Commands(commands.Cog):
             await interaction.response.send_message("❌ You need administrator permissions to use this command.", ephemeral=True)
             return
         
-        if not self.check_mongodb():
+        if self.bot.user_stats is None:
             await interaction.response.send_message("❌ Database connection not available", ephemeral=True)
             return
         
         await interaction.response.defer()
         
         try:
-            users = self.db.users.count_documents({})
-            active = self.db.users.count_documents({"status": "active"})
-            banned = self.db.users.count_documents({"status": "banned"})
-            
-            embed = discord.Embed(title="📊 Database Statistics", color=0x0099ff)
-            embed.add_field(name="Total Users", value=users, inline=True)
-            embed.add_field(name="Active Users", value=active, inline=True)
-            embed.add_field(name="Banned Users", value=banned, inline=True)
+            embed = self.db_stats_embed(await self.bot.user_stats.get())
             embed.set_footer(text=f"Requested by {interaction.user.name}")
             await interaction.followup.send(embed=embed)
         except Exception as e:
@@ -194,17 +224,18 @@ class Commands(commands.Cog):
             await interaction.response.send_message("❌ You need administrator permissions to use this command.", ephemeral=True)
             return
         
-        if not self.check_mongodb():
+        if not await self.check_mongodb():
             await interaction.response.send_message("❌ Database connection not available", ephemeral=True)
             return
         
         await interaction.response.defer()
         
         try:
-            result = self.db.users.update_one(
+            result = await self.db.users.update_one(
                 {"username": username},
                 {"$set": {"status": "banned", "ban_reason": reason, "banned_at": datetime.utcnow()}}
             )
+            self.bot.user_cache.invalidate(username)
             
             if result.modified_count > 0:
                 embed = discord.Embed(
@@ -228,14 +259,19 @@ class Commands(commands.Cog):
         if username is None:
             username = interaction.user.name
         
-        if not self.check_mongodb():
+        try:
+            available, user = await self.find_user(username)
+        except Exception as e:
+            logger.error(f"Error in slash info command: {e}")
+            await interaction.response.send_message("❌ Error fetching user information", ephemeral=True)
+            return
+        if not available:
             await interaction.response.send_message("❌ Database connection not available", ephemeral=True)
             return
         
         await interaction.response.defer()
         
         try:
-            user = self.db.users.find_one({"username": username})
             if not user:
                 await interaction.followup.send(f"❌ User **{username}** not found", ephemeral=True)
                 return
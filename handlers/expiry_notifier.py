@@ -1,56 +1,189 @@
 import discord
 from discord.ext import commands
-import pymongo
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 import os
 import asyncio
+from pymongo import ReturnDocument
+from services.scheduler import DeadlineScheduler
+from services.sweeps import SweepDigest, bulk_transition
 
 load_dotenv()
 
+# Days before expiry at which a reminder is sent
+EXPIRY_THRESHOLDS = (7, 3, 1)
+# How far ahead users are loaded into the in-memory schedule
+SCHEDULE_HORIZON = timedelta(days=int(os.getenv('EXPIRY_SCHEDULE_HORIZON_DAYS', 8)))
+SCHEDULE_RELOAD_INTERVAL = 86400
+EXPIRY_FIELDS = {'expiry_date', 'status', 'expiry_notices'}
+# Wait before retrying a reminder whose message couldn't be sent
+NOTICE_RETRY_DELAY = timedelta(seconds=int(os.getenv('EXPIRY_NOTICE_RETRY_SECONDS', 300)))
+
+def notice_key(expiry_date, days):
+    """Marker stored in expiry_notices once a reminder for this expiry is sent"""
+    return f"{expiry_date.isoformat()}:{days}"
+
 class ExpiryNotifier(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.mongo_client = pymongo.MongoClient(os.getenv('MONGO_URI'))
-        self.db = self.mongo_client['minecraft_proxy']
+        self.db = bot.database.db
         self.channel_id = int(os.getenv('DISCORD_CHANNEL_ID'))
-        self.bot.loop.create_task(self.check_expiries())
+        self.scheduler = DeadlineScheduler(self.handle_due, name='expiry scheduler')
+        # user _id -> when reminders that failed to send may be tried again
+        self.notice_retry_at = {}
+        
+        # Keep the schedule in sync with user inserts, renewals and deletions
+        self.change_stream = bot.change_streams.subscribe(
+            'users',
+            name='expiry_notifier',
+            operation_types=['insert', 'update', 'replace', 'delete'],
+            fields=['_id', 'username', 'expiry_date', 'status', 'license_type', 'expiry_notices'],
+            full_document=True
+        )
+        self.bot.loop.create_task(self.load_schedule())
+        self.bot.loop.create_task(self.watch_users())
+        self.bot.loop.create_task(self.scheduler.run())
 
-    async def check_expiries(self):
+    async def load_schedule(self):
+        """Expire overdue users in bulk, then load everyone expiring within the horizon, once a day"""
         while True:
             try:
-                # Check for expiries in the next 7 days
-                seven_days_from_now = datetime.utcnow() + timedelta(days=7)
-                expiring_users = self.db.users.find({
-                    "expiry_date": {
-                        "$lte": seven_days_from_now,
-                        "$gt": datetime.utcnow()
-                    }
-                })
-
-                for user in expiring_users:
-                    days_remaining = (user['expiry_date'] - datetime.utcnow()).days
-                    if days_remaining in [1, 3, 7]:  # Notify at 7, 3, and 1 days before expiry
-                        await self.send_expiry_notification(user, days_remaining)
-
-                # Check for expired users
-                expired_users = self.db.users.find({
-                    "expiry_date": {"$lte": datetime.utcnow()},
-                    "status": "active"
-                })
-
-                for user in expired_users:
-                    await self.send_expired_notification(user)
-                    # Update user status to expired
-                    self.db.users.update_one(
-                        {"_id": user["_id"]},
-                        {"$set": {"status": "expired"}}
-                    )
+                await self.sweep_expired()
+
+                now = datetime.utcnow()
+                users = self.db.users.find(
+                    {
+                        "status": "active",
+                        "expiry_date": {"$gt": now, "$lte": now + SCHEDULE_HORIZON}
+                    },
+                    {"username": 1, "expiry_date": 1, "status": 1, "license_type": 1, "expiry_notices": 1}
+                )
+                async for user in users:
+                    self.schedule_user(user)
+            except Exception as e:
+                print(f"Error loading expiry schedule: {e}")
+
+            await asyncio.sleep(SCHEDULE_RELOAD_INTERVAL)
+
+    async def sweep_expired(self):
+        """Flip every active user whose license has already expired, with one digest alert"""
+        digest = SweepDigest()
+        batches = bulk_transition(
+            self.db.users,
+            {"status": "active", "expiry_date": {"$lte": datetime.utcnow()}},
+            {"$set": {"status": "expired"}},
+            {"username": 1, "expiry_date": 1, "license_type": 1}
+        )
+        async for batch in batches:
+            digest.add(batch)
+            for user in batch:
+                self.scheduler.cancel(user['_id'])
 
+        if digest.total:
+            await self.send_expired_digest(digest)
+
+    async def watch_users(self):
+        while True:
+            try:
+                change = await self.change_stream.get()
+                if change['operationType'] == 'delete':
+                    self.scheduler.cancel(change['documentKey']['_id'])
+                    continue
+                if change['operationType'] == 'update':
+                    updated = change.get('updateDescription', {})
+                    touched = set(updated.get('updatedFields', {})) | set(updated.get('removedFields', []))
+                    if not touched & EXPIRY_FIELDS:
+                        continue
+                if change.get('fullDocument'):
+                    self.schedule_user(change['fullDocument'])
             except Exception as e:
-                print(f"Error in expiry checker: {e}")
+                print(f"Error in expiry watcher: {e}")
+                continue
+
+    def schedule_user(self, user):
+        """Queue the reminders and expiry transition still pending for a user"""
+        expiry_date = user.get('expiry_date')
+        now = datetime.utcnow()
+        if user.get('status') != 'active' or not expiry_date or expiry_date > now + SCHEDULE_HORIZON:
+            self.scheduler.cancel(user['_id'])
+            self.notice_retry_at.pop(user['_id'], None)
+            return
 
-            await asyncio.sleep(3600)  # Check every hour
+        sent = set(user.get('expiry_notices', []))
+        entries = []
+        for days in EXPIRY_THRESHOLDS:
+            notify_at = expiry_date - timedelta(days=days)
+            if notice_key(expiry_date, days) in sent:
+                continue
+            # After downtime only the most recent overdue reminder is worth sending
+            if notify_at <= now and entries and entries[-1][0] <= now:
+                entries.pop()
+            entries.append((notify_at, days))
+        entries.append((expiry_date, 0))
+
+        # Reminders whose send just failed wait for the retry time
+        retry_at = self.notice_retry_at.get(user['_id'])
+        if retry_at is not None:
+            entries = [(max(due_at, retry_at), days) for due_at, days in entries[:-1]] + entries[-1:]
+        self.scheduler.schedule(user['_id'], [(due_at, (days, user)) for due_at, days in entries])
+
+    async def handle_due(self, user_id, payload):
+        days, user = payload
+        if days == 0:
+            await self.expire_user(user)
+        else:
+            await self.notify_expiring(user, days)
+
+    async def notify_expiring(self, user, days):
+        expiry_date = user['expiry_date']
+        if expiry_date <= datetime.utcnow():
+            return
+
+        # Claim this reminder (and any larger one it supersedes) before sending,
+        # so each threshold is announced once across restarts
+        keys = [notice_key(expiry_date, threshold) for threshold in EXPIRY_THRESHOLDS if threshold >= days]
+        before = await self.db.users.find_one_and_update(
+            {
+                "_id": user["_id"],
+                "status": "active",
+                "expiry_date": expiry_date,
+                "expiry_notices": {"$ne": notice_key(expiry_date, days)}
+            },
+            {"$addToSet": {"expiry_notices": {"$each": keys}}},
+            projection={"expiry_notices": 1},
+            return_document=ReturnDocument.BEFORE
+        )
+        if before is None:
+            return
+
+        days_remaining = (expiry_date - datetime.utcnow()).days + 1
+        try:
+            await self.send_expiry_notification(user, min(days, days_remaining))
+        except Exception:
+            # Release what this call claimed so the reminder is retried, not lost
+            sent = before.get('expiry_notices', [])
+            claimed = [key for key in keys if key not in sent]
+            self.notice_retry_at[user["_id"]] = datetime.utcnow() + NOTICE_RETRY_DELAY
+            await self.db.users.update_one(
+                {"_id": user["_id"]},
+                {"$pull": {"expiry_notices": {"$in": claimed}}}
+            )
+            self.schedule_user({**user, 'expiry_notices': sent})
+            raise
+        self.notice_retry_at.pop(user["_id"], None)
+
+    async def expire_user(self, user):
+        # Update user status to expired
+        result = await self.db.users.update_one(
+            {
+                "_id": user["_id"],
+                "status": "active",
+                "expiry_date": {"$lte": datetime.utcnow()}
+            },
+            {"$set": {"status": "expired"}}
+        )
+        if result.modified_count > 0:
+            await self.send_expired_notification(user)
 
     async def send_expiry_notification(self, user, days_remaining):
         channel = self.bot.get_channel(self.channel_id)
@@ -87,5 +220,22 @@ class ExpiryNotifier(commands.Cog):
         
         await channel.send(embed=embed)
 
+    async def send_expired_digest(self, digest):
+        channel = self.bot.get_channel(self.channel_id)
+        if not channel:
+            return
+
+        embed = discord.Embed(
+            title=f"❌ Licenses Expired ({digest.total} users)",
+            description=digest.lines(
+                lambda user: f"• {user.get('username', 'N/A')} ({user.get('license_type', 'N/A')}) - "
+                             f"expired {user['expiry_date'].strftime('%Y-%m-%d %H:%M UTC')}"
+            ),
+            color=discord.Color.red(),
+            timestamp=datetime.utcnow()
+        )
+        
+        await channel.send(embed=embed)
+
 async def setup(bot):
-    await bot.add_cog(ExpiryNotifier(bot)) 
\ No newline at end of file
+    await bot.add_cog(ExpiryNotifier(bot))
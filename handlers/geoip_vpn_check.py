@@ -1,36 +1,61 @@
 import discord
 from discord.ext import commands
-import pymongo
-import geoip2.database
-import requests
 from dotenv import load_dotenv
 import os
+import time
+import asyncio
+from collections import deque
 from datetime import datetime
+from services import metrics
+from services.consumers import consume
+from services.worker_pool import KeyedWorkerPool
+from services.login_enrichment import enrichment_fields
 
 load_dotenv()
 
+# Budget for all of one login's lookups; stages still running are dropped
+LOGIN_CHECK_DEADLINE = float(os.getenv('LOGIN_CHECK_DEADLINE', 5))
+
 class GeoIPVPNCheck(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.mongo_client = pymongo.MongoClient(os.getenv('MONGO_URI'))
-        self.db = self.mongo_client['minecraft_proxy']
+        self.db = bot.database.db
+        self.login_profiles = bot.login_profiles
+        self.geoip = bot.geoip
+        self.vpn = bot.vpn
+        self.ip_reputation = bot.ip_reputation
+        self.enrichment = bot.login_enrichment
         self.channel_id = int(os.getenv('DISCORD_CHANNEL_ID'))
+        # stage -> recent latencies (seconds), timeouts and errors
+        self.stage_latency = {}
+        self.stage_timeouts = {}
+        self.stage_errors = {}
+        metrics.register("login_checks", self.stage_metrics)
         
         # Set up change stream for login events
-        self.change_stream = self.db.login_logs.watch(
-            [{'$match': {'operationType': 'insert'}}]
+        self.change_stream = bot.change_streams.subscribe(
+            'login_logs',
+            name='geoip_vpn_check',
+            fields=['_id', 'username', 'hwid', 'ip_address', 'timestamp', 'country']
+        )
+        # Logins are handled concurrently, in order per username
+        self.workers = KeyedWorkerPool(
+            'geoip_vpn_check', bot.dead_letters.supervise('geoip_vpn_check', 'login_logs', self.check_login)
         )
-        self.bot.loop.create_task(self.watch_logins())
+        self.workers.start()
+        self.watch_task = self.bot.loop.create_task(self.watch_logins())
+
+    async def cog_unload(self):
+        # Stop taking events, then let the queued ones finish before the
+        # final checkpoint is written past them
+        self.watch_task.cancel()
+        await self.workers.drain()
 
     async def watch_logins(self):
-        while True:
-            try:
-                change = self.change_stream.next()
-                if change['operationType'] == 'insert':
-                    await self.check_login(change['fullDocument'])
-            except Exception as e:
-                print(f"Error in login watcher: {e}")
-                continue
+        await consume(self.change_stream, self.submit_login, deferred=True)
+
+    async def submit_login(self, login_doc, done):
+        await self.workers.submit(login_doc.get('username'), login_doc, done)
 
     async def check_login(self, login_doc):
         ip = login_doc.get('ip_address')
@@ -40,50 +65,97 @@ class GeoIPVPNCheck(commands.Cog):
         if not ip or not hwid:
             return
 
-        # Check if IP is from a VPN/proxy
-        is_vpn = await self.check_vpn(ip)
-        
-        # Get country from IP
-        country = await self.get_country(ip)
-        
+        # VPN verdict, country and login profile don't depend on each other,
+        # so they run side by side within one deadline
+        stages = {
+            'vpn': self.check_vpn(ip),
+            'geo': self.get_geo(ip),
+        }
+        if username:
+            stages['profile'] = self.login_profiles.get(username)
+        results = await self.run_stages(stages)
+
+        is_vpn = results.get('vpn')
+        geo = results.get('geo')
+        country = geo.country if geo else "Unknown"
+
+        # Store what was learned on the login itself, in batches
+        if geo and login_doc.get('_id') is not None:
+            self.enrichment.add(login_doc['_id'], enrichment_fields(geo, is_vpn))
+
         # Check for suspicious patterns
-        suspicious = await self.check_suspicious_patterns(username, ip, hwid, country)
+        suspicious = False
+        if 'profile' in results:
+            profile = await self.login_profiles.observe(login_doc, country=country)
+            suspicious = self.check_suspicious_patterns(profile, hwid)
+        elif username:
+            # The profile is still loading; fold this login in once it has
+            self.bot.loop.create_task(self.observe_later(login_doc, country))
         
         if is_vpn or suspicious:
             await self.send_alert(username, ip, country, hwid, is_vpn, suspicious)
 
     async def check_vpn(self, ip):
-        try:
-            response = requests.get(f"https://proxycheck.io/v2/{ip}?key=YOUR_API_KEY&vpn=1")
-            data = response.json()
-            return data.get(ip, {}).get('proxy', 'no') == 'yes'
-        except:
-            return False
+        # Known VPN/hosting ranges are answered locally, without the provider
+        if self.ip_reputation.lookup(ip):
+            return True
+        # None when no verdict could be had in time; treated as not a VPN
+        return await self.vpn.check(ip)
+
+    async def get_geo(self, ip):
+        return self.geoip.lookup(ip)
 
-    async def get_country(self, ip):
+    async def observe_later(self, login_doc, country):
         try:
-            with geoip2.database.Reader('GeoLite2-Country.mmdb') as reader:
-                response = reader.country(ip)
-                return response.country.name
-        except:
-            return "Unknown"
+            await self.login_profiles.observe(login_doc, country=country)
+        except Exception as e:
+            print(f"Error updating login profile: {e}")
 
-    async def check_suspicious_patterns(self, username, ip, hwid, country):
+    async def run_stages(self, stages):
+        """Run the stages concurrently; name -> result for those that finished in time"""
+        tasks = {name: asyncio.ensure_future(self.timed_stage(name, stage)) for name, stage in stages.items()}
+        done, pending = await asyncio.wait(tasks.values(), timeout=LOGIN_CHECK_DEADLINE)
+
+        results = {}
+        for name, task in tasks.items():
+            if task in pending:
+                task.cancel()
+                self.stage_timeouts[name] = self.stage_timeouts.get(name, 0) + 1
+            elif task.exception() is not None:
+                self.stage_errors[name] = self.stage_errors.get(name, 0) + 1
+                print(f"Error in login check stage {name}: {task.exception()}")
+            else:
+                results[name] = task.result()
+        return results
+
+    async def timed_stage(self, name, stage):
+        started = time.monotonic()
+        result = await stage
+        self.stage_latency.setdefault(name, deque(maxlen=1000)).append(time.monotonic() - started)
+        return result
+
+    def stage_metrics(self):
+        """Per-stage latency over the last 1000 logins, plus timeouts and errors"""
+        result = {"deadline_seconds": LOGIN_CHECK_DEADLINE}
+        for name in set(self.stage_latency) | set(self.stage_timeouts) | set(self.stage_errors):
+            latencies = sorted(self.stage_latency.get(name, ()))
+            result[name] = {
+                "count": len(latencies),
+                "avg_ms": round(sum(latencies) / len(latencies) * 1000, 2) if latencies else 0.0,
+                "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 2) if latencies else 0.0,
+                "max_ms": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+                "timeouts": self.stage_timeouts.get(name, 0),
+                "errors": self.stage_errors.get(name, 0)
+            }
+        return result
+
+    def check_suspicious_patterns(self, profile, hwid):
         # Check for multiple IPs from different countries
-        user_logins = self.db.login_logs.find({"username": username})
-        countries = set()
-        for login in user_logins:
-            if login.get('country'):
-                countries.add(login['country'])
-        
-        if len(countries) > 2:  # More than 2 different countries
+        if len(profile.countries) > 2:  # More than 2 different countries
             return True
             
         # Check for multiple HWIDs
-        hwid_count = self.db.login_logs.count_documents({
-            "username": username,
-            "hwid": {"$ne": hwid}
-        })
+        hwid_count = profile.other_hwids(hwid)
         
         return hwid_count > 0
 
@@ -113,5 +185,26 @@ class GeoIPVPNCheck(commands.Cog):
         
         await channel.send(embed=embed)
 
+    @commands.command()
+    @commands.has_permissions(administrator=True)
+    async def backfill_logins(self, ctx, max_documents: int = 100000):
+        """Add country, ASN and listed-VPN fields to older logins, resuming where the last run stopped"""
+        if self.enrichment.backfill_running:
+            await ctx.send("❌ A login backfill is already running")
+            return
+
+        await ctx.send(f"⏳ Enriching up to {max_documents:,} older logins...")
+        try:
+            enriched, finished = await self.enrichment.backfill(max_documents=max_documents)
+        except Exception as e:
+            print(f"Error in login backfill: {e}")
+            await ctx.send("❌ Login backfill failed; run the command again to resume")
+            return
+
+        if finished:
+            await ctx.send(f"✅ Enriched {enriched:,} logins; the backfill is complete")
+        else:
+            await ctx.send(f"✅ Enriched {enriched:,} logins; run the command again to continue")
+
 async def setup(bot):
     await bot.add_cog(GeoIPVPNCheck(bot)) 
\ No newline at end of file
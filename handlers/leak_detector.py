@@ -1,64 +1,84 @@
 import discord
 from discord.ext import commands
-import pymongo
 from dotenv import load_dotenv
 import os
-from datetime import datetime, timedelta
+import asyncio
+from datetime import datetime
+from services.consumers import consume
+from services.worker_pool import KeyedWorkerPool
+from services.sharing import format_window
+from services.login_sketches import MAX_HORIZON
 
 load_dotenv()
 
 class LeakDetector(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.mongo_client = pymongo.MongoClient(os.getenv('MONGO_URI'))
-        self.db = self.mongo_client['minecraft_proxy']
+        self.db = bot.database.db
+        self.login_profiles = bot.login_profiles
+        self.login_sketches = bot.login_sketches
+        self.sharing = bot.sharing
         self.channel_id = int(os.getenv('DISCORD_CHANNEL_ID'))
         
         # Set up change stream for login events
-        self.change_stream = self.db.login_logs.watch(
-            [{'$match': {'operationType': 'insert'}}]
+        self.change_stream = bot.change_streams.subscribe(
+            'login_logs',
+            name='leak_detector',
+            fields=['_id', 'username', 'hwid', 'ip_address', 'timestamp', 'country']
         )
-        self.bot.loop.create_task(self.watch_logins())
+        # Logins are handled concurrently, in order per username
+        self.workers = KeyedWorkerPool(
+            'leak_detector', bot.dead_letters.supervise('leak_detector', 'login_logs', self.check_for_leaks)
+        )
+        self.workers.start()
+        self.watch_task = self.bot.loop.create_task(self.watch_logins())
+
+    async def cog_unload(self):
+        # Stop taking events, then let the queued ones finish before the
+        # final checkpoint is written past them
+        self.watch_task.cancel()
+        await self.workers.drain()
 
     async def watch_logins(self):
-        while True:
-            try:
-                change = self.change_stream.next()
-                if change['operationType'] == 'insert':
-                    await self.check_for_leaks(change['fullDocument'])
-            except Exception as e:
-                print(f"Error in leak detector: {e}")
-                continue
+        await consume(self.change_stream, self.submit_login, deferred=True)
+
+    async def submit_login(self, login_doc, done):
+        await self.workers.submit(login_doc.get('username'), login_doc, done)
 
     async def check_for_leaks(self, login_doc):
         username = login_doc.get('username')
         hwid = login_doc.get('hwid')
         ip = login_doc.get('ip_address')
 
+        # One HWID or IP across many accounts, from in-memory windows only
+        alerts = self.sharing.observe(username, hwid=hwid, ip=ip, timestamp=login_doc.get('timestamp'))
+        for index, alert in enumerate(alerts):
+            try:
+                await self.send_sharing_alert(alert)
+            except Exception:
+                # Undelivered alerts must fire again when the login is retried
+                for undelivered in alerts[index:]:
+                    self.sharing.release(undelivered)
+                raise
+
         if not username or not hwid or not ip:
             return
 
-        # Check for multiple HWIDs
-        hwid_count = self.db.login_logs.count_documents({
-            "username": username,
-            "hwid": {"$ne": hwid}
-        })
+        profile, sketch = await asyncio.gather(
+            self.login_profiles.observe(login_doc),
+            self.login_sketches.observe(login_doc)
+        )
 
-        # Check for multiple IPs in last 24 hours
-        recent_logins = self.db.login_logs.find({
-            "username": username,
-            "timestamp": {"$gte": datetime.utcnow() - timedelta(hours=24)},
-            "ip_address": {"$ne": ip}
-        })
+        # Check for multiple HWIDs over the longest sketch horizon
+        hwid_count = max(sketch.distinct_hwids() - 1, 0)
 
-        unique_ips = set()
-        for login in recent_logins:
-            unique_ips.add(login['ip_address'])
+        # Check for multiple IPs in last 24 hours
+        unique_ips = profile.recent_other_ips(ip)
 
         if hwid_count > 0 or len(unique_ips) > 1:
-            await self.send_leak_alert(username, hwid, ip, hwid_count, len(unique_ips))
+            await self.send_leak_alert(username, hwid, ip, hwid_count, len(unique_ips), sketch)
 
-    async def send_leak_alert(self, username, hwid, ip, hwid_count, ip_count):
+    async def send_leak_alert(self, username, hwid, ip, hwid_count, ip_count, sketch):
         channel = self.bot.get_channel(self.channel_id)
         if not channel:
             return
@@ -75,29 +95,50 @@ class LeakDetector(commands.Cog):
         
         reasons = []
         if hwid_count > 0:
-            reasons.append(f"Multiple HWIDs detected ({hwid_count + 1} total)")
+            reasons.append(f"Multiple HWIDs detected ({hwid_count + 1} in {MAX_HORIZON} days)")
         if ip_count > 1:
             reasons.append(f"Multiple IPs in last 24 hours ({ip_count} total)")
             
         embed.add_field(name="Alert Reasons", value="\n".join(reasons), inline=False)
         
-        # Get all known HWIDs and IPs
-        all_logins = self.db.login_logs.find({"username": username})
-        known_hwids = set()
-        known_ips = set()
-        
-        for login in all_logins:
-            if login.get('hwid'):
-                known_hwids.add(login['hwid'])
-            if login.get('ip_address'):
-                known_ips.add(login['ip_address'])
-        
-        if known_hwids:
-            embed.add_field(name="Known HWIDs", value="\n".join(known_hwids), inline=False)
-        if known_ips:
-            embed.add_field(name="Known IPs", value="\n".join(known_ips), inline=False)
+        # Distinct counts and top IPs come from the fixed-size sketch
+        for kind, label in (('hwids', "Distinct HWIDs"), ('ips', "Distinct IPs")):
+            counts = sketch.horizons(kind)
+            embed.add_field(
+                name=label,
+                value=" · ".join(f"{days}d: {count}" for days, count in counts.items()),
+                inline=False
+            )
+
+        top_ips = sketch.top_ips.top(5)
+        if top_ips:
+            approx = "" if sketch.top_ips.exact else "~"
+            embed.add_field(
+                name="Top IPs",
+                value="\n".join(f"{top_ip} ({approx}{count} logins)" for top_ip, count in top_ips),
+                inline=False
+            )
         
         await channel.send(embed=embed)
 
+    async def send_sharing_alert(self, alert):
+        channel = self.bot.get_channel(self.channel_id)
+        if not channel:
+            return
+
+        labels = {'hwid': "HWID", 'ip': "IP", 'subnet': "Subnet"}
+        embed = discord.Embed(
+            title=f"🚨 Shared {labels[alert.kind]} Across Accounts",
+            color=discord.Color.red(),
+            timestamp=datetime.utcnow()
+        )
+
+        embed.add_field(name=labels[alert.kind], value=alert.key, inline=True)
+        embed.add_field(name="Accounts", value=f"{alert.count} in {format_window(alert.window)}", inline=True)
+        embed.add_field(name="Threshold", value=alert.threshold, inline=True)
+        embed.add_field(name="Recent Accounts", value="\n".join(alert.accounts), inline=False)
+
+        await channel.send(embed=embed)
+
 async def setup(bot):
     await bot.add_cog(LeakDetector(bot)) 
\ No newline at end of file
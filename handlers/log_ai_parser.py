@@ -1,63 +1,115 @@
 import discord
 from discord.ext import commands
-import pymongo
 from dotenv import load_dotenv
 import os
+import time
 from datetime import datetime, timedelta
-import re
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+from services.log_scanner import SUMMARY_CATEGORIES, classify, default_scanner
+from services.log_content import ChunkDecoder, LOG_CHUNK_SIZE, has_content
+from services.log_rollups import LogRollups, ceil_hour, floor_hour
+from services.log_templates import (
+    LOG_TEMPLATE_MAX_CLUSTERS, TOP_TEMPLATES, TemplateMiner, format_templates, merge_templates
+)
+from services.log_workers import LogAnalysisPool
+from services.consumers import consume
 
 load_dotenv()
 
+LOG_GRIDFS_BUCKET = os.getenv('LOG_GRIDFS_BUCKET', 'fs')
+# A log whose matching lines all fit templates reported within this many
+# seconds is counted but not summarised again
+LOG_TEMPLATE_REPORT_INTERVAL = int(os.getenv('LOG_TEMPLATE_REPORT_INTERVAL', 3600))
+
 class LogAIParser(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.mongo_client = pymongo.MongoClient(os.getenv('MONGO_URI'))
-        self.db = self.mongo_client['minecraft_proxy']
+        self.db = bot.database.db
         self.channel_id = int(os.getenv('DISCORD_CHANNEL_ID'))
+        self.scanner = default_scanner()
+        self.miner = TemplateMiner()
+        # template -> when it was last summarised (monotonic), oldest first
+        self.reported_templates = OrderedDict()
+        self.rollups = LogRollups(self.db)
+        self.pool = LogAnalysisPool()
         
         # Set up change stream for log events
-        self.change_stream = self.db.logs.watch(
-            [{'$match': {'operationType': 'insert'}}]
+        self.change_stream = bot.change_streams.subscribe(
+            'logs',
+            name='log_parser',
+            fields=['content', 'content_file_id', 'source', 'timestamp']
         )
+        self.bot.loop.create_task(self.rollups.start())
+        self.handle_log = bot.dead_letters.supervise('log_parser', 'logs', self.analyze_log)
         self.bot.loop.create_task(self.watch_logs())
 
+    async def cog_unload(self):
+        await self.rollups.flush()
+        self.pool.close()
+
     async def watch_logs(self):
+        await consume(self.change_stream, self.handle_log)
+
+    async def scan_log(self, log_doc):
+        """Scan a log in the worker processes when it is large, in place otherwise"""
+        if log_doc.get('content_file_id') is None:
+            return await self.pool.scan(log_doc.get('content') or '', self.scanner, self.miner)
+
+        # GridFS payloads are read here and scanned in segments across the workers
+        chunks = self.read_gridfs(log_doc['content_file_id'])
+        return await self.pool.scan_stream(chunks, self.scanner, self.miner)
+
+    async def read_gridfs(self, file_id):
+        """Yield a GridFS log's text one chunk at a time"""
+        bucket = AsyncIOMotorGridFSBucket(self.db, bucket_name=LOG_GRIDFS_BUCKET)
+        stream = await bucket.open_download_stream(file_id)
+        decoder = ChunkDecoder()
         while True:
-            try:
-                change = self.change_stream.next()
-                if change['operationType'] == 'insert':
-                    await self.analyze_log(change['fullDocument'])
-            except Exception as e:
-                print(f"Error in log parser: {e}")
-                continue
+            data = await stream.read(LOG_CHUNK_SIZE)
+            if not data:
+                break
+            for chunk in decoder.feed(data):
+                yield chunk
+        yield decoder.flush()
 
     async def analyze_log(self, log_doc):
-        log_content = log_doc.get('content', '')
-        if not log_content:
+        if not has_content(log_doc):
             return
 
-        # Analyze log patterns
-        patterns = {
-            'errors': r'(?i)(error|exception|failed|crash)',
-            'warnings': r'(?i)(warning|warn)',
-            'connections': r'(?i)(connect|disconnect|join|leave)',
-            'security': r'(?i)(hack|cheat|exploit|inject)',
-            'performance': r'(?i)(lag|timeout|slow|performance)'
-        }
-
-        findings = defaultdict(list)
-        for category, pattern in patterns.items():
-            matches = re.finditer(pattern, log_content)
-            for match in matches:
-                # Get some context around the match
-                start = max(0, match.start() - 50)
-                end = min(len(log_content), match.end() + 50)
-                context = log_content[start:end].strip()
-                findings[category].append(context)
-
-        if any(findings.values()):
-            await self.send_log_summary(log_doc, findings)
+        # Analyze log patterns in a single pass
+        findings = await self.scan_log(log_doc)
+
+        # Nothing is recorded until the summary is sent, so a retry after a
+        # failed send neither counts the log twice nor skips its summary
+        if any(findings.counts.get(category) for category in SUMMARY_CATEGORIES):
+            if self.has_unreported(findings.flagged):
+                await self.send_log_summary(log_doc, findings)
+                self.mark_reported(findings.flagged)
+
+        self.rollups.add(log_doc, *classify(findings), findings.templates)
+
+    def has_unreported(self, templates):
+        """False if every template was already reported, recently"""
+        if not templates:
+            return True
+        now = time.monotonic()
+        for template in templates:
+            reported_at = self.reported_templates.get(template)
+            if reported_at is None or now - reported_at >= LOG_TEMPLATE_REPORT_INTERVAL:
+                return True
+        return False
+
+    def mark_reported(self, templates):
+        """Record templates as reported now, unless they already were recently"""
+        now = time.monotonic()
+        for template in templates:
+            reported_at = self.reported_templates.pop(template, None)
+            if reported_at is None or now - reported_at >= LOG_TEMPLATE_REPORT_INTERVAL:
+                reported_at = now
+            self.reported_templates[template] = reported_at
+        while len(self.reported_templates) > LOG_TEMPLATE_MAX_CLUSTERS:
+            self.reported_templates.popitem(last=False)
 
     async def send_log_summary(self, log_doc, findings):
         channel = self.bot.get_channel(self.channel_id)
@@ -79,24 +131,34 @@ class LogAIParser(commands.Cog):
         )
 
         # Add findings for each category
-        for category, contexts in findings.items():
-            if contexts:
+        for category in SUMMARY_CATEGORIES:
+            count = findings.counts.get(category, 0)
+            if count:
                 # Limit to 3 examples per category
-                examples = contexts[:3]
+                examples = findings.contexts(category)[:3]
                 value = "\n\n".join([f"• {ctx}" for ctx in examples])
-                if len(contexts) > 3:
-                    value += f"\n\n... and {len(contexts) - 3} more"
+                if count > 3:
+                    value += f"\n\n... and {count - 3} more"
                 embed.add_field(
-                    name=f"{category.title()} ({len(contexts)})",
+                    name=f"{category.title()} ({count})",
                     value=value,
                     inline=False
                 )
 
+        # Recurring lines are reported once per template with their count
+        recurring = {template: count for template, count in findings.templates.items() if count > 1}
+        if recurring:
+            embed.add_field(
+                name="Recurring Lines",
+                value=format_templates(recurring),
+                inline=False
+            )
+
         # Add severity assessment
         severity = "Low"
-        if len(findings['errors']) > 0:
+        if findings.counts.get('errors'):
             severity = "High"
-        elif len(findings['warnings']) > 0:
+        elif findings.counts.get('warnings'):
             severity = "Medium"
 
         embed.add_field(
@@ -111,33 +173,54 @@ class LogAIParser(commands.Cog):
     @commands.has_permissions(administrator=True)
     async def analyze_logs(self, ctx, hours: int = 24):
         """Analyze logs from the last X hours"""
-        start_time = datetime.utcnow() - timedelta(hours=hours)
-        
-        logs = self.db.logs.find({
-            "timestamp": {"$gte": start_time}
-        })
+        now = datetime.utcnow()
+        start_time = now - timedelta(hours=hours)
 
         # Collect statistics
         stats = defaultdict(int)
         error_patterns = defaultdict(int)
-        
-        for log in logs:
-            content = log.get('content', '')
-            if not content:
-                continue
-
-            # Count log types
-            if re.search(r'(?i)error|exception', content):
-                stats['errors'] += 1
-            elif re.search(r'(?i)warning', content):
-                stats['warnings'] += 1
-            elif re.search(r'(?i)connect|disconnect', content):
-                stats['connections'] += 1
-
-            # Analyze error patterns
-            for pattern in ['timeout', 'crash', 'failed', 'invalid']:
-                if re.search(pattern, content, re.I):
-                    error_patterns[pattern] += 1
+        templates = {}
+
+        # Whole hours come from the rollups; only the partial hours at either
+        # end, and anything before the rollups began, are scanned raw
+        raw_ranges = [(start_time, now)]
+        if self.rollups.since is not None:
+            rolled_from = max(ceil_hour(start_time), self.rollups.since)
+            rolled_to = floor_hour(now)
+            if rolled_from < rolled_to:
+                log_types, patterns, rolled_templates = await self.rollups.totals(rolled_from, rolled_to)
+                merge_templates(templates, rolled_templates)
+                for log_type, count in log_types.items():
+                    if count:
+                        stats[log_type] += count
+                for pattern, count in patterns.items():
+                    if count:
+                        error_patterns[pattern] += count
+                raw_ranges = [(start_time, rolled_from), (rolled_to, now)]
+
+        async def raw_contents():
+            for range_start, range_end in raw_ranges:
+                if range_start >= range_end:
+                    continue
+                logs = self.db.logs.find(
+                    {"timestamp": {"$gte": range_start, "$lt": range_end}},
+                    {"content": 1, "content_file_id": 1}
+                )
+                async for log in logs:
+                    if log.get('content_file_id') is not None:
+                        # GridFS payloads are split across the workers rather than shipped whole
+                        findings = await self.scan_log(log)
+                        merge_templates(templates, findings.templates, limit=TOP_TEMPLATES * 10)
+                        log_type, patterns = classify(findings)
+                        if log_type:
+                            stats[log_type] += 1
+                        for pattern in patterns:
+                            error_patterns[pattern] += 1
+                    elif log.get('content'):
+                        yield log['content']
+
+        # Count log types and error patterns across the worker processes
+        await self.pool.classify_logs(raw_contents(), self.miner, stats, error_patterns, templates)
 
         # Create summary embed
         embed = discord.Embed(
@@ -155,6 +238,10 @@ class LogAIParser(commands.Cog):
             error_summary = "\n".join([f"• {pattern}: {count}" for pattern, count in error_patterns.items()])
             embed.add_field(name="Common Error Patterns", value=error_summary, inline=False)
 
+        # Add the most frequent line templates
+        if templates:
+            embed.add_field(name="Top Log Templates", value=format_templates(templates), inline=False)
+
         await ctx.send(embed=embed)
 
 async def setup(bot):
@@ -1,34 +1,31 @@
 import discord
 from discord.ext import commands
-import pymongo
 from dotenv import load_dotenv
 import os
 from datetime import datetime
+from services.consumers import consume
 
 load_dotenv()
 
 class Registration(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.mongo_client = pymongo.MongoClient(os.getenv('MONGO_URI'))
-        self.db = self.mongo_client['minecraft_proxy']
+        self.db = bot.database.db
         self.channel_id = int(os.getenv('DISCORD_CHANNEL_ID'))
         
         # Set up change stream for new user documents
-        self.change_stream = self.db.users.watch(
-            [{'$match': {'operationType': 'insert'}}]
+        self.change_stream = bot.change_streams.subscribe(
+            'users',
+            name='registrations',
+            fields=['username', 'email', 'license_type', 'expiry_date', 'ip_address', 'country']
+        )
+        self.handle_registration = bot.dead_letters.supervise(
+            'registrations', 'users', self.send_registration_alert
         )
         self.bot.loop.create_task(self.watch_registrations())
 
     async def watch_registrations(self):
-        while True:
-            try:
-                change = self.change_stream.next()
-                if change['operationType'] == 'insert':
-                    await self.send_registration_alert(change['fullDocument'])
-            except Exception as e:
-                print(f"Error in registration watcher: {e}")
-                continue
+        await consume(self.change_stream, self.handle_registration)
 
     async def send_registration_alert(self, user_doc):
         channel = self.bot.get_channel(self.channel_id)
@@ -1,6 +1,5 @@
 import discord
 from discord.ext import commands
-import pymongo
 from datetime import datetime
 from dotenv import load_dotenv
 import os
@@ -11,8 +10,7 @@ load_dotenv()
 class Welcome(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.mongo_client = pymongo.MongoClient(os.getenv('MONGO_URI'))
-        self.db = self.mongo_client['minecraft_proxy']
+        self.db = bot.database.db
         self.channel_id = int(os.getenv('DISCORD_CHANNEL_ID'))
         
         # Default welcome messages
@@ -27,7 +25,7 @@ class Welcome(commands.Cog):
     @commands.Cog.listener()
     async def on_member_join(self, member):
         # Check if user exists in database
-        user = self.db.users.find_one({"username": member.name})
+        user = await self.bot.user_cache.get(member.name)
         if not user:
             return
             
@@ -68,10 +66,11 @@ class Welcome(commands.Cog):
     @commands.has_permissions(administrator=True)
     async def setwelcome(self, ctx, username: str, *, message: str):
         """Set a custom welcome message for a user"""
-        result = self.db.users.update_one(
+        result = await self.db.users.update_one(
             {"username": username},
             {"$set": {"welcome_message": message}}
         )
+        self.bot.user_cache.invalidate(username)
         
         if result.modified_count > 0:
             await ctx.send(f"✅ Welcome message set for {username}")
@@ -82,10 +81,11 @@ class Welcome(commands.Cog):
     @commands.has_permissions(administrator=True)
     async def resetwelcome(self, ctx, username: str):
         """Reset welcome message to default for a user"""
-        result = self.db.users.update_one(
+        result = await self.db.users.update_one(
             {"username": username},
             {"$unset": {"welcome_message": ""}}
         )
+        self.bot.user_cache.invalidate(username)
         
         if result.modified_count > 0:
             await ctx.send(f"✅ Welcome message reset for {username}")
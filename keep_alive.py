@@ -10,6 +10,7 @@ from logging.handlers import RotatingFileHandler
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
+from services import metrics as service_metrics
 
 # Configure logging
 logging.basicConfig(
@@ -104,7 +105,8 @@ def health():
             "memory_warning": memory_warning,
             "last_gc": datetime.fromtimestamp(last_gc_time).strftime('%Y-%m-%d %H:%M:%S'),
             "environment": os.getenv('ENVIRONMENT', 'production'),
-            "port": PORT
+            "port": PORT,
+            "users": service_metrics.get('users')
         }
         
         return jsonify(response)
@@ -153,7 +155,8 @@ def metrics():
                 "uptime": time.time() - start_time,
                 "port": PORT,
                 "environment": os.getenv('ENVIRONMENT', 'production')
-            }
+            },
+            "services": service_metrics.snapshot()
         })
     except Exception as e:
         logger.error(f"Error in metrics: {e}")
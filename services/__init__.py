@@ -0,0 +1 @@
+"""Shared, bot-owned services used by the handler cogs"""
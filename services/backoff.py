@@ -0,0 +1,27 @@
+import asyncio
+import random
+
+
+class Backoff:
+    """Exponential backoff with jitter for retry loops.
+
+    The n-th consecutive failure waits between half and all of
+    min(maximum, base * 2**n) seconds, so retries spread out instead of
+    hammering a broken dependency in lockstep. reset() after a success.
+    """
+
+    def __init__(self, base=0.5, maximum=60.0):
+        self.base = base
+        self.maximum = maximum
+        self.failures = 0
+
+    def delay(self):
+        ceiling = min(self.maximum, self.base * 2 ** self.failures)
+        self.failures += 1
+        return random.uniform(ceiling / 2, ceiling)
+
+    async def wait(self):
+        await asyncio.sleep(self.delay())
+
+    def reset(self):
+        self.failures = 0
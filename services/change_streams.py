@@ -0,0 +1,349 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from datetime import datetime
+
+from pymongo.errors import OperationFailure
+
+from services import metrics
+from services.backoff import Backoff
+from services.metrics import RateMeter
+
+logger = logging.getLogger('change_streams')
+
+CHANGE_STREAM_QUEUE_SIZE = int(os.getenv('CHANGE_STREAM_QUEUE_SIZE', 1000))
+# A broken stream is reopened after a jittered delay doubling from
+# RETRY_DELAY up to RETRY_MAX_DELAY, reset once events flow again
+CHANGE_STREAM_RETRY_DELAY = float(os.getenv('CHANGE_STREAM_RETRY_DELAY', 1))
+CHANGE_STREAM_RETRY_MAX_DELAY = float(os.getenv('CHANGE_STREAM_RETRY_MAX_DELAY', 60))
+CHECKPOINT_INTERVAL = int(os.getenv('CHANGE_STREAM_CHECKPOINT_INTERVAL', 10))
+# Max events/sec replayed while catching up after a restart (0 = unlimited)
+CATCHUP_RATE = float(os.getenv('CHANGE_STREAM_CATCHUP_RATE', 200))
+
+# Server error codes meaning the resume token has fallen off the oplog
+HISTORY_LOST_CODES = (280, 286)
+
+# Change event fields every subscriber gets, whatever it asked for
+EVENT_FIELDS = ['operationType', 'clusterTime', 'documentKey']
+
+
+class Subscription:
+    """One consumer's bounded queue of change events for a collection"""
+
+    def __init__(self, collection_name, name, operation_types, fields, full_document, maxsize):
+        self.collection_name = collection_name
+        self.name = name
+        self.operation_types = set(operation_types)
+        self.fields = fields
+        self.full_document = full_document
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        # Sequence numbers of events handed to put() but not yet taken
+        self.pending = deque()
+        # Sequence numbers taken by take() whose handling hasn't finished,
+        # in the order they were taken
+        self.in_flight = {}
+
+        self.events_received = 0
+        self.events_consumed = 0
+        self.backpressure_seconds = 0.0
+        self.last_lag = 0.0
+        self.rate = RateMeter()
+
+        metrics.register(f"change_stream.{self.name}", self.stats)
+
+    async def put(self, seq, change):
+        self.events_received += 1
+        self.rate.mark()
+        self.pending.append(seq)
+        item = (time.monotonic(), change)
+        if self.queue.full():
+            # Backpressure: block the shared reader until this consumer catches up
+            blocked_at = time.monotonic()
+            await self.queue.put(item)
+            self.backpressure_seconds += time.monotonic() - blocked_at
+        else:
+            self.queue.put_nowait(item)
+
+    async def get(self):
+        """Wait for the next change event, counting it consumed straight away"""
+        seq, change = await self.take()
+        self.done(seq)
+        return change
+
+    async def take(self):
+        """Wait for the next change event; it counts as consumed once done(seq) is called"""
+        received_at, change = await self.queue.get()
+        seq = self.pending.popleft()
+        self.in_flight[seq] = True
+        self.events_consumed += 1
+        self.last_lag = event_lag(change, received_at)
+        return seq, change
+
+    def done(self, seq):
+        """Mark a taken event as handled, letting the checkpoint move past it"""
+        self.in_flight.pop(seq, None)
+
+    def first_unfinished(self):
+        """Lowest sequence number not yet handled, or None if all are"""
+        for seq in self.in_flight:
+            return seq
+        return self.pending[0] if self.pending else None
+
+    def stats(self):
+        return {
+            "collection": self.collection_name,
+            "queue_depth": self.queue.qsize(),
+            "queue_size": self.queue.maxsize,
+            "in_flight": len(self.in_flight),
+            "events_received": self.events_received,
+            "events_consumed": self.events_consumed,
+            "events_per_second": round(self.rate.rate(), 2),
+            "lag_seconds": round(self.last_lag, 3),
+            "backpressure_seconds": round(self.backpressure_seconds, 3)
+        }
+
+
+class CheckpointStore:
+    """Persists the last fully consumed resume token of each stream"""
+
+    def __init__(self, db):
+        self.collection = db.stream_checkpoints
+
+    async def load(self, name):
+        doc = await self.collection.find_one({"_id": name})
+        return doc.get('resume_token') if doc else None
+
+    async def save(self, name, token):
+        await self.collection.update_one(
+            {"_id": name},
+            {"$set": {"resume_token": token, "updated_at": datetime.utcnow()}},
+            upsert=True
+        )
+
+    async def clear(self, name):
+        await self.collection.delete_one({"_id": name})
+
+
+class CollectionStream:
+    """The single change stream opened for one collection, fanned out to its subscribers"""
+
+    def __init__(self, collection, checkpoints):
+        self.collection = collection
+        self.name = collection.name
+        self.checkpoints = checkpoints
+        self.subscriptions = []
+        self.events_received = 0
+        self.events_caught_up = 0
+        self.reopens = 0
+        self.backoff = Backoff(CHANGE_STREAM_RETRY_DELAY, CHANGE_STREAM_RETRY_MAX_DELAY)
+        self._task = None
+
+        # Resume token of the last event handed to every subscriber
+        self.resume_token = None
+        self.resume_loaded = False
+        # (seq, token) of dispatched events not yet checkpointed
+        self.uncheckpointed = deque()
+        self.dispatched_seq = 0
+        self.checkpointed_token = None
+        self.started_at = None
+        self._next_catchup_slot = 0.0
+
+    def pipeline(self):
+        """Match only the wanted operations and project only the wanted fields"""
+        operation_types = set()
+        for subscription in self.subscriptions:
+            operation_types |= subscription.operation_types
+        pipeline = [{'$match': {'operationType': {'$in': sorted(operation_types)}}}]
+
+        if all(subscription.fields is not None for subscription in self.subscriptions):
+            projection = {field: 1 for field in EVENT_FIELDS}
+            for subscription in self.subscriptions:
+                for field in subscription.fields:
+                    projection[f"fullDocument.{field}"] = 1
+            if 'update' in operation_types:
+                projection['updateDescription'] = 1
+            pipeline.append({'$project': projection})
+        return pipeline
+
+    def watch_kwargs(self):
+        if any(subscription.full_document for subscription in self.subscriptions):
+            return {'full_document': 'updateLookup'}
+        return {}
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def restart(self):
+        self.stop()
+        self.start()
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        self.started_at = time.time()
+        while True:
+            try:
+                if not self.resume_loaded:
+                    self.resume_token = await self.checkpoints.load(self.name)
+                    self.checkpointed_token = self.resume_token
+                    self.resume_loaded = True
+                    if self.resume_token:
+                        logger.info(f"Resuming change stream for {self.name} from checkpoint")
+
+                kwargs = self.watch_kwargs()
+                if self.resume_token:
+                    kwargs['start_after'] = self.resume_token
+                async with self.collection.watch(self.pipeline(), **kwargs) as stream:
+                    async for change in stream:
+                        await self._throttle_catchup(change)
+                        await self._dispatch(change)
+            except asyncio.CancelledError:
+                raise
+            except OperationFailure as e:
+                if e.code in HISTORY_LOST_CODES:
+                    logger.warning(f"Checkpoint for {self.name} is no longer in the oplog, starting from now")
+                    self.resume_token = None
+                    await self.checkpoints.clear(self.name)
+                else:
+                    await self._retry_later(e)
+            except Exception as e:
+                await self._retry_later(e)
+            self.reopens += 1
+
+    async def _retry_later(self, error):
+        delay = self.backoff.delay()
+        logger.error(f"Error in change stream for {self.name}, reopening in {delay:.1f}s: {error}")
+        await asyncio.sleep(delay)
+
+    async def _throttle_catchup(self, change):
+        """Pace events written before startup so a backlog can't flood the consumers"""
+        cluster_time = change.get('clusterTime')
+        if not CATCHUP_RATE or cluster_time is None or cluster_time.time >= self.started_at:
+            return
+        self.events_caught_up += 1
+        now = time.monotonic()
+        self._next_catchup_slot = max(self._next_catchup_slot, now)
+        if self._next_catchup_slot > now:
+            await asyncio.sleep(self._next_catchup_slot - now)
+        self._next_catchup_slot += 1 / CATCHUP_RATE
+
+    async def _dispatch(self, change):
+        self.events_received += 1
+        self.backoff.reset()
+        seq = self.dispatched_seq + 1
+        for subscription in self.subscriptions:
+            if change['operationType'] in subscription.operation_types:
+                await subscription.put(seq, change)
+        self.dispatched_seq = seq
+        self.resume_token = change['_id']
+        self.uncheckpointed.append((seq, change['_id']))
+
+    def consumed_seq(self):
+        """Highest sequence number every subscriber has finished, along with all before it"""
+        consumed = self.dispatched_seq
+        for subscription in self.subscriptions:
+            first = subscription.first_unfinished()
+            if first is not None:
+                consumed = min(consumed, first - 1)
+        return consumed
+
+    async def checkpoint(self):
+        """Persist the newest token whose event every subscriber has consumed"""
+        consumed = self.consumed_seq()
+        token = None
+        while self.uncheckpointed and self.uncheckpointed[0][0] <= consumed:
+            token = self.uncheckpointed.popleft()[1]
+        if token is not None and token != self.checkpointed_token:
+            await self.checkpoints.save(self.name, token)
+            self.checkpointed_token = token
+
+
+class ChangeStreamHub:
+    """Opens one change stream per collection and fans events out in process.
+
+    Cogs register interest with subscribe() while they load; the hub merges
+    their operation types and fields into a single server-side $match and
+    $project so each collection costs one cursor and only the needed bytes.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.checkpoints = CheckpointStore(db)
+        self.streams = {}
+        self.started = False
+        self._checkpoint_task = None
+        metrics.register("change_stream_hub", self.stats)
+
+    def subscribe(self, collection_name, name, operation_types=('insert',), fields=None,
+                  full_document=False, maxsize=CHANGE_STREAM_QUEUE_SIZE):
+        """Register a consumer and return its Subscription.
+
+        fields limits the fullDocument fields sent over the wire (None means
+        the whole document); full_document asks for the post-image on updates.
+        """
+        stream = self.streams.get(collection_name)
+        if stream is None:
+            stream = self.streams[collection_name] = CollectionStream(self.db[collection_name], self.checkpoints)
+
+        subscription = Subscription(collection_name, name, operation_types, fields, full_document, maxsize)
+        stream.subscriptions.append(subscription)
+
+        # A late subscriber changes the pipeline, so reopen the stream
+        if self.started:
+            stream.restart()
+        return subscription
+
+    def start(self):
+        """Open every collection's stream; called once all cogs have subscribed"""
+        self.started = True
+        for stream in self.streams.values():
+            stream.start()
+        self._checkpoint_task = asyncio.create_task(self._checkpoint_loop())
+
+    async def _checkpoint_loop(self):
+        while True:
+            await asyncio.sleep(CHECKPOINT_INTERVAL)
+            await self.checkpoint()
+
+    async def checkpoint(self):
+        for stream in self.streams.values():
+            try:
+                await stream.checkpoint()
+            except Exception as e:
+                logger.error(f"Error checkpointing change stream for {stream.name}: {e}")
+
+    async def close(self):
+        """Stop every stream and flush the final checkpoints"""
+        self.started = False
+        if self._checkpoint_task is not None:
+            self._checkpoint_task.cancel()
+            self._checkpoint_task = None
+        for stream in self.streams.values():
+            stream.stop()
+        await self.checkpoint()
+
+    def stats(self):
+        return {
+            name: {
+                "subscribers": [subscription.name for subscription in stream.subscriptions],
+                "events_received": stream.events_received,
+                "events_caught_up": stream.events_caught_up,
+                "reopens": stream.reopens,
+                "uncheckpointed_events": len(stream.uncheckpointed)
+            }
+            for name, stream in self.streams.items()
+        }
+
+
+def event_lag(change, received_at):
+    """Seconds between the server-side write and the consumer picking it up"""
+    cluster_time = change.get('clusterTime')
+    if cluster_time is not None:
+        return max(0.0, time.time() - cluster_time.time)
+    return time.monotonic() - received_at
@@ -0,0 +1,195 @@
+import asyncio
+import functools
+import logging
+import os
+from datetime import datetime
+
+from services import metrics
+from services.backoff import Backoff
+
+logger = logging.getLogger('consumers')
+
+# Attempts at one event before it is moved to the dead letters
+CONSUMER_MAX_ATTEMPTS = int(os.getenv('CONSUMER_MAX_ATTEMPTS', 3))
+CONSUMER_RETRY_DELAY = float(os.getenv('CONSUMER_RETRY_DELAY', 0.5))
+CONSUMER_RETRY_MAX_DELAY = float(os.getenv('CONSUMER_RETRY_MAX_DELAY', 30))
+DEAD_LETTER_MAX = int(os.getenv('DEAD_LETTER_MAX', 10000))
+DEAD_LETTER_REPLAY_BATCH = int(os.getenv('DEAD_LETTER_REPLAY_BATCH', 100))
+# The store is trimmed back to DEAD_LETTER_MAX every this many additions
+DEAD_LETTER_TRIM_EVERY = 100
+
+
+async def consume(subscription, handler, operation_types=('insert',), deferred=False):
+    """Feed a change-stream subscription's documents to handler, forever.
+
+    handler gets each matching event's fullDocument, and the event only
+    counts as consumed for checkpointing once handler returns. With
+    deferred=True handler is called as handler(document, done) and the
+    event counts as consumed when done() is called instead, for handlers
+    that hand events on to be processed later. If taking events keeps
+    failing, the loop backs off instead of spinning.
+    """
+    backoff = Backoff(CONSUMER_RETRY_DELAY, CONSUMER_RETRY_MAX_DELAY)
+    while True:
+        seq = None
+        try:
+            seq, change = await subscription.take()
+            if change['operationType'] in operation_types:
+                if deferred:
+                    done, seq = functools.partial(subscription.done, seq), None
+                    await handler(change['fullDocument'], done)
+                else:
+                    await handler(change['fullDocument'])
+            backoff.reset()
+        except asyncio.CancelledError:
+            # Left unfinished, so the event is replayed after a restart
+            raise
+        except Exception as e:
+            delay = backoff.delay()
+            logger.error(f"Error in {subscription.name} consumer, retrying in {delay:.1f}s: {e}")
+            if seq is not None:
+                subscription.done(seq)
+            await asyncio.sleep(delay)
+            continue
+        if seq is not None:
+            subscription.done(seq)
+
+
+class SupervisedHandler:
+    """Wraps an event handler so one bad event can't be lost or stall the rest.
+
+    A failing event is retried up to CONSUMER_MAX_ATTEMPTS times with
+    jittered exponential backoff, then stored in the dead letters to be
+    replayed later, and the consumer moves on.
+    """
+
+    def __init__(self, store, consumer, collection, handler, max_attempts=CONSUMER_MAX_ATTEMPTS):
+        self.store = store
+        self.consumer = consumer
+        self.collection = collection
+        self.handler = handler
+        self.max_attempts = max_attempts
+
+    async def __call__(self, event):
+        backoff = Backoff(CONSUMER_RETRY_DELAY, CONSUMER_RETRY_MAX_DELAY)
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                return await self.handler(event)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                error = e
+                self.store.retries += 1
+                if attempt < self.max_attempts:
+                    delay = backoff.delay()
+                    logger.warning(
+                        f"{self.consumer} failed on an event (attempt {attempt}), retrying in {delay:.1f}s: {e}"
+                    )
+                    await asyncio.sleep(delay)
+
+        logger.error(f"{self.consumer} failed on an event {self.max_attempts} times, dead-lettering it: {error}")
+        await self.store.add(self.consumer, self.collection, event, error, self.max_attempts)
+
+
+class DeadLetterStore:
+    """Events whose handlers kept failing, kept in the dead_letters collection.
+
+    The store holds at most DEAD_LETTER_MAX events, dropping the oldest
+    beyond that. Each consumer registers its handler through supervise(),
+    so replay() can hand stored events back to it in batches; events that
+    succeed are removed and the rest stay for another try.
+    """
+
+    def __init__(self, db, max_size=DEAD_LETTER_MAX):
+        self.collection = db.dead_letters
+        self.max_size = max_size
+        # consumer name -> handler events are replayed through
+        self.handlers = {}
+        self._added_since_trim = 0
+
+        self.retries = 0
+        self.dead_lettered = 0
+        self.replayed = 0
+        self.trimmed = 0
+        metrics.register("dead_letters", self.stats)
+
+    def supervise(self, consumer, collection, handler):
+        """Wrap handler with retries and dead-lettering, and make it the consumer's replay target"""
+        self.handlers[consumer] = handler
+        return SupervisedHandler(self, consumer, collection, handler)
+
+    async def add(self, consumer, collection, event, error, attempts):
+        self.dead_lettered += 1
+        try:
+            await self.collection.insert_one({
+                "consumer": consumer,
+                "collection": collection,
+                "event": event,
+                "error": f"{type(error).__name__}: {error}",
+                "attempts": attempts,
+                "failed_at": datetime.utcnow()
+            })
+            self._added_since_trim += 1
+            if self._added_since_trim >= DEAD_LETTER_TRIM_EVERY:
+                self._added_since_trim = 0
+                await self.trim()
+        except Exception as e:
+            logger.error(f"Could not store dead letter for {consumer}: {e}")
+
+    async def trim(self):
+        """Drop the oldest events beyond max_size"""
+        excess = await self.collection.count_documents({}) - self.max_size
+        if excess <= 0:
+            return
+        oldest = await self.collection.find({}, {"_id": 1}).sort("_id", 1).limit(excess).to_list(length=excess)
+        result = await self.collection.delete_many({"_id": {"$in": [doc["_id"] for doc in oldest]}})
+        self.trimmed += result.deleted_count
+        logger.warning(f"Dropped {result.deleted_count} oldest dead letters over the limit of {self.max_size}")
+
+    async def counts(self):
+        """Stored events per consumer"""
+        pipeline = [{"$group": {"_id": "$consumer", "count": {"$sum": 1}}}]
+        return {row["_id"]: row["count"] async for row in self.collection.aggregate(pipeline)}
+
+    async def replay(self, consumer=None, limit=None, batch_size=DEAD_LETTER_REPLAY_BATCH):
+        """Hand stored events back to their handlers, oldest first; return (replayed, failed)"""
+        consumers = [consumer] if consumer else list(self.handlers)
+        consumers = [name for name in consumers if name in self.handlers]
+        replayed = failed = 0
+        last_id = None
+        while consumers and (limit is None or replayed + failed < limit):
+            query = {"consumer": {"$in": consumers}}
+            if last_id is not None:
+                query["_id"] = {"$gt": last_id}
+            size = batch_size if limit is None else min(batch_size, limit - replayed - failed)
+            batch = await self.collection.find(query).sort("_id", 1).limit(size).to_list(length=size)
+            if not batch:
+                break
+            last_id = batch[-1]["_id"]
+
+            done = []
+            for doc in batch:
+                try:
+                    await self.handlers[doc["consumer"]](doc["event"])
+                    done.append(doc["_id"])
+                except Exception as e:
+                    failed += 1
+                    await self.collection.update_one(
+                        {"_id": doc["_id"]},
+                        {"$set": {"error": f"{type(e).__name__}: {e}", "replayed_at": datetime.utcnow()},
+                         "$inc": {"replay_attempts": 1}}
+                    )
+            if done:
+                await self.collection.delete_many({"_id": {"$in": done}})
+            replayed += len(done)
+            self.replayed += len(done)
+        return replayed, failed
+
+    def stats(self):
+        return {
+            "retries": self.retries,
+            "dead_lettered": self.dead_lettered,
+            "replayed": self.replayed,
+            "trimmed": self.trimmed,
+            "consumers": sorted(self.handlers)
+        }
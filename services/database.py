@@ -0,0 +1,48 @@
+from motor.motor_asyncio import AsyncIOMotorClient
+import os
+import logging
+
+logger = logging.getLogger('database')
+
+DATABASE_NAME = 'minecraft_proxy'
+
+
+class Database:
+    """Shared async MongoDB client used by every cog.
+
+    Motor runs the blocking pymongo I/O on a thread pool, so awaiting a query
+    never holds up gateway heartbeats or interaction responses.
+    """
+
+    def __init__(self, uri, db_name=DATABASE_NAME):
+        self.client = AsyncIOMotorClient(
+            uri,
+            maxPoolSize=int(os.getenv('MONGO_MAX_POOL_SIZE', 50)),
+            serverSelectionTimeoutMS=5000
+        )
+        self.db = self.client[db_name]
+
+    async def ping(self):
+        """Check if MongoDB is reachable"""
+        try:
+            await self.client.admin.command('ping')
+            return True
+        except Exception as e:
+            logger.error(f"MongoDB connection lost: {e}")
+            return False
+
+    def close(self):
+        self.client.close()
+
+
+async def create_database():
+    """Create the shared database connection, or None if MONGO_URI is not set"""
+    mongo_uri = os.getenv('MONGO_URI')
+    if not mongo_uri:
+        logger.warning("MONGO_URI not found in environment variables")
+        return None
+
+    database = Database(mongo_uri)
+    if await database.ping():
+        logger.info("MongoDB connection established successfully")
+    return database
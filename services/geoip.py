@@ -0,0 +1,170 @@
+import asyncio
+import logging
+import os
+from collections import OrderedDict, namedtuple
+
+import geoip2.database
+import geoip2.errors
+from maxminddb import MODE_MMAP
+
+from services import metrics
+
+logger = logging.getLogger('geoip')
+
+GEOIP_COUNTRY_DB = os.getenv('GEOIP_COUNTRY_DB', 'GeoLite2-Country.mmdb')
+# Optional; ASN fields are None without it
+GEOIP_ASN_DB = os.getenv('GEOIP_ASN_DB', 'GeoLite2-ASN.mmdb')
+GEOIP_CACHE_SIZE = int(os.getenv('GEOIP_CACHE_SIZE', 50000))
+GEOIP_RELOAD_INTERVAL = int(os.getenv('GEOIP_RELOAD_INTERVAL', 60))
+
+UNKNOWN = "Unknown"
+
+GeoInfo = namedtuple('GeoInfo', ['country', 'asn', 'as_org'])
+
+
+def open_reader(path):
+    """Memory-map a .mmdb file; return (reader, mtime), or (None, None) if it is missing"""
+    if not path or not os.path.exists(path):
+        return None, None
+    mtime = os.path.getmtime(path)
+    return geoip2.database.Reader(path, mode=MODE_MMAP), mtime
+
+
+class GeoIP:
+    """Country and ASN lookups over GeoLite2 databases opened once for the bot.
+
+    The .mmdb files are memory-mapped rather than read per login, and
+    results are kept in an LRU cache of GEOIP_CACHE_SIZE addresses, so a
+    repeat lookup is a dict hit. Every GEOIP_RELOAD_INTERVAL seconds the
+    files' mtimes are checked; a changed database is reopened off the event
+    loop, swapped in and the cache cleared.
+    """
+
+    def __init__(self, country_path=GEOIP_COUNTRY_DB, asn_path=GEOIP_ASN_DB, cache_size=GEOIP_CACHE_SIZE):
+        self.paths = {'country': country_path, 'asn': asn_path}
+        self.readers = {'country': None, 'asn': None}
+        self.mtimes = {'country': None, 'asn': None}
+        self.cache_size = cache_size
+        # ip -> GeoInfo, least recently used first
+        self.cache = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.reloads = 0
+
+        for name, path in self.paths.items():
+            try:
+                self.readers[name], self.mtimes[name] = open_reader(path)
+            except Exception as e:
+                logger.error(f"Error opening GeoIP {name} database {path}: {e}")
+        if self.readers['country'] is None:
+            logger.warning(f"GeoIP country database {country_path} not available; countries will be {UNKNOWN}")
+        metrics.register("geoip", self.stats)
+
+    def start(self):
+        asyncio.create_task(self._reload_loop())
+
+    def lookup(self, ip):
+        """Country and ASN of one address, from the cache when possible"""
+        info = self.cache.get(ip)
+        if info is not None:
+            self.hits += 1
+            self.cache.move_to_end(ip)
+            return info
+
+        self.misses += 1
+        info = self.resolve(ip)
+        self.cache[ip] = info
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+            self.evictions += 1
+        return info
+
+    async def lookup_many(self, ips):
+        """ip -> GeoInfo for a batch, e.g. a backfill.
+
+        Cached addresses are answered directly; the rest are resolved in a
+        worker thread and not cached, so a one-off sweep over old logins
+        doesn't flush the addresses live logins keep hitting.
+        """
+        results = {}
+        missing = []
+        for ip in set(ips):
+            info = self.cache.get(ip)
+            if info is not None:
+                self.hits += 1
+                results[ip] = info
+            else:
+                missing.append(ip)
+        if missing:
+            self.misses += len(missing)
+            resolved = await asyncio.to_thread(lambda: {ip: self.resolve(ip) for ip in missing})
+            results.update(resolved)
+        return results
+
+    def resolve(self, ip):
+        """Look an address up in the databases, bypassing the cache"""
+        country = UNKNOWN
+        asn = as_org = None
+        country_reader = self.readers['country']
+        asn_reader = self.readers['asn']
+        if country_reader is not None:
+            try:
+                country = country_reader.country(ip).country.name or UNKNOWN
+            except (geoip2.errors.AddressNotFoundError, ValueError):
+                pass
+        if asn_reader is not None:
+            try:
+                response = asn_reader.asn(ip)
+                asn = response.autonomous_system_number
+                as_org = response.autonomous_system_organization
+            except (geoip2.errors.AddressNotFoundError, ValueError):
+                pass
+        return GeoInfo(country, asn, as_org)
+
+    async def reload(self):
+        """Reopen any database whose file changed on disk; True if one did"""
+        reloaded = False
+        for name, path in self.paths.items():
+            try:
+                mtime = os.path.getmtime(path) if path and os.path.exists(path) else None
+                if mtime is None or mtime == self.mtimes[name]:
+                    continue
+                reader, mtime = await asyncio.to_thread(open_reader, path)
+            except Exception as e:
+                # Most likely caught mid-copy; the next check retries
+                logger.error(f"Error reloading GeoIP {name} database {path}: {e}")
+                continue
+            # The old reader is left to the garbage collector, since a
+            # lookup_many thread may still be using it
+            self.readers[name] = reader
+            self.mtimes[name] = mtime
+            reloaded = True
+            logger.info(f"Reloaded GeoIP {name} database {path}")
+        if reloaded:
+            self.cache.clear()
+            self.reloads += 1
+        return reloaded
+
+    async def _reload_loop(self):
+        while True:
+            await asyncio.sleep(GEOIP_RELOAD_INTERVAL)
+            try:
+                await self.reload()
+            except Exception as e:
+                logger.error(f"Error checking GeoIP databases: {e}")
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "country_db": self.readers['country'] is not None,
+            "asn_db": self.readers['asn'] is not None,
+            "size": len(self.cache),
+            "max_size": self.cache_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "evictions": self.evictions,
+            "reloads": self.reloads
+        }
@@ -0,0 +1,193 @@
+import argparse
+import asyncio
+import logging
+import os
+import sys
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure, PyMongoError
+
+from services.database import DATABASE_NAME
+
+logger = logging.getLogger('indexes')
+
+# Compound indexes backing every handler query, per collection
+INDEXES = {
+    'login_logs': [
+        IndexModel([('username', ASCENDING), ('timestamp', DESCENDING)], name='username_timestamp'),
+        IndexModel([('username', ASCENDING), ('hwid', ASCENDING)], name='username_hwid'),
+        IndexModel([('username', ASCENDING), ('ip_address', ASCENDING)], name='username_ip_address'),
+    ],
+    'users': [
+        IndexModel([('username', ASCENDING)], name='username'),
+        IndexModel([('status', ASCENDING), ('expiry_date', ASCENDING)], name='status_expiry_date'),
+        IndexModel([('status', ASCENDING), ('last_login', ASCENDING)], name='status_last_login'),
+    ],
+    'logs': [
+        IndexModel([('timestamp', ASCENDING)], name='timestamp'),
+    ],
+    'log_rollups': [
+        IndexModel([('hour', ASCENDING)], name='hour'),
+    ],
+    'dead_letters': [
+        IndexModel([('consumer', ASCENDING), ('_id', ASCENDING)], name='consumer_id'),
+    ],
+}
+
+
+def handler_queries():
+    """The queries the handlers run, with representative values, for explain()"""
+    now = datetime.utcnow()
+    return [
+        {
+            'name': 'activity: recent logins',
+            'collection': 'login_logs',
+            'filter': {'username': 'example'},
+            'sort': {'timestamp': -1},
+            'limit': 10
+        },
+        {
+            'name': 'login profiles: bootstrap',
+            'collection': 'login_logs',
+            'pipeline': [
+                {'$match': {'username': 'example'}},
+                {'$group': {'_id': '$ip_address', 'last_seen': {'$max': '$timestamp'}}}
+            ]
+        },
+        {
+            'name': 'login sketches: bootstrap',
+            'collection': 'login_logs',
+            'pipeline': [
+                {'$match': {
+                    'username': 'example',
+                    'timestamp': {'$gte': now - timedelta(days=90)},
+                    '_id': {'$lt': ObjectId()}
+                }},
+                {'$group': {'_id': '$ip_address', 'last_seen': {'$max': '$timestamp'}, 'logins': {'$sum': 1}}}
+            ]
+        },
+        {
+            'name': 'login enrichment: backfill batch',
+            'collection': 'login_logs',
+            'filter': {'enriched_at': {'$exists': False}, '_id': {'$gt': ObjectId()}},
+            'sort': {'_id': 1},
+            'limit': 1000
+        },
+        {
+            'name': 'users: lookup by username',
+            'collection': 'users',
+            'filter': {'username': 'example'}
+        },
+        {
+            'name': 'activity tracker: inactivity sweep',
+            'collection': 'users',
+            'filter': {'status': 'active', 'last_login': {'$lt': now - timedelta(days=7)}}
+        },
+        {
+            'name': 'expiry notifier: expired sweep',
+            'collection': 'users',
+            'filter': {'status': 'active', 'expiry_date': {'$lte': now}}
+        },
+        {
+            'name': 'expiry notifier: schedule horizon',
+            'collection': 'users',
+            'filter': {'status': 'active', 'expiry_date': {'$lte': now + timedelta(days=8)}}
+        },
+        {
+            'name': 'log parser: logs in window',
+            'collection': 'logs',
+            'filter': {'timestamp': {'$gte': now - timedelta(hours=24), '$lt': now}}
+        },
+        {
+            'name': 'dead letters: replay batch',
+            'collection': 'dead_letters',
+            'filter': {'consumer': {'$in': ['leak_detector']}, '_id': {'$gt': ObjectId()}},
+            'sort': {'_id': 1},
+            'limit': 100
+        },
+        {
+            'name': 'log parser: hourly rollups',
+            'collection': 'log_rollups',
+            'filter': {'hour': {'$gte': now - timedelta(days=30), '$lt': now}}
+        },
+    ]
+
+
+async def ensure_indexes(db):
+    """Create any missing indexes; existing identical indexes are left alone"""
+    for collection_name, indexes in INDEXES.items():
+        try:
+            names = await db[collection_name].create_indexes(indexes)
+            logger.info(f"Ensured indexes on {collection_name}: {', '.join(names)}")
+        except OperationFailure as e:
+            logger.error(f"Failed to create indexes on {collection_name}: {e}")
+        except PyMongoError as e:
+            # Server unreachable: start without them rather than not at all
+            logger.error(f"Skipping index creation, MongoDB is unavailable: {e}")
+            return
+
+
+def plan_nodes(plan):
+    """Yield every dict nested anywhere in an explain() result"""
+    if isinstance(plan, dict):
+        yield plan
+        for value in plan.values():
+            yield from plan_nodes(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from plan_nodes(value)
+
+
+async def explain(db, query):
+    if 'pipeline' in query:
+        command = {'aggregate': query['collection'], 'pipeline': query['pipeline'], 'cursor': {}}
+    else:
+        command = {'find': query['collection'], 'filter': query['filter']}
+        if 'sort' in query:
+            command['sort'] = query['sort']
+        if 'limit' in query:
+            command['limit'] = query['limit']
+    return await db.command('explain', command, verbosity='queryPlanner')
+
+
+async def verify_query_plans(db):
+    """Explain every handler query and raise if any winning plan is a COLLSCAN"""
+    failures = []
+    for query in handler_queries():
+        result = await explain(db, query)
+        # Only the winning plan matters; rejected plans may legitimately scan
+        winning = [node['winningPlan'] for node in plan_nodes(result) if 'winningPlan' in node]
+        if any(node.get('stage') == 'COLLSCAN' for plan in winning for node in plan_nodes(plan)):
+            failures.append(query['name'])
+        else:
+            logger.info(f"Query plan OK: {query['name']}")
+
+    if failures:
+        raise RuntimeError(f"Queries fall back to COLLSCAN: {', '.join(failures)}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Ensure handler indexes and verify their query plans")
+    parser.add_argument('--uri', default=os.getenv('MONGO_URI', 'mongodb://localhost:27017'))
+    parser.add_argument('--verify', action='store_true', help="fail if any handler query does a COLLSCAN")
+    args = parser.parse_args()
+
+    client = AsyncIOMotorClient(args.uri, serverSelectionTimeoutMS=5000)
+    db = client[DATABASE_NAME]
+    try:
+        await ensure_indexes(db)
+        if args.verify:
+            await verify_query_plans(db)
+    except RuntimeError as e:
+        logger.error(str(e))
+        sys.exit(1)
+    finally:
+        client.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(message)s')
+    asyncio.run(main())
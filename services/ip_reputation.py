@@ -0,0 +1,193 @@
+import asyncio
+import ipaddress
+import logging
+import os
+from array import array
+from bisect import bisect_right
+from datetime import datetime
+
+from services import metrics
+
+logger = logging.getLogger('ip_reputation')
+
+# One list per file, named for its category: vpn.txt, hosting.netset, ...
+IP_REPUTATION_DIR = os.getenv('IP_REPUTATION_DIR', 'ip_lists')
+IP_REPUTATION_RELOAD_INTERVAL = int(os.getenv('IP_REPUTATION_RELOAD_INTERVAL', 300))
+
+
+class RangeTable:
+    """Disjoint, sorted address ranges of one IP family, each with its categories.
+
+    Lookups are a bisect over the start addresses. IPv4 bounds are packed
+    in 32-bit arrays; IPv6 ones are too wide for array and stay in lists.
+    """
+
+    def __init__(self, ranges, wide):
+        # ranges: [(first, last, category)], possibly overlapping
+        events = []
+        for first, last, category in ranges:
+            events.append((first, 1, category))
+            events.append((last + 1, -1, category))
+        events.sort(key=lambda event: (event[0], event[1]))
+
+        starts, ends, categories = [], [], []
+        active = {}
+        position = None
+        for address, delta, category in events:
+            if active and position is not None and address > position:
+                segment = tuple(sorted(active))
+                if ends and ends[-1] == position - 1 and categories[-1] == segment:
+                    ends[-1] = address - 1
+                else:
+                    starts.append(position)
+                    ends.append(address - 1)
+                    categories.append(segment)
+            count = active.get(category, 0) + delta
+            if count:
+                active[category] = count
+            else:
+                active.pop(category, None)
+            position = address
+
+        if wide:
+            self.starts, self.ends = starts, ends
+        else:
+            self.starts, self.ends = array('I', starts), array('I', ends)
+        self.categories = categories
+
+    def __len__(self):
+        return len(self.starts)
+
+    def lookup(self, address):
+        i = bisect_right(self.starts, address) - 1
+        if i >= 0 and address <= self.ends[i]:
+            return self.categories[i]
+        return ()
+
+
+def read_lists(directory):
+    """(first, last, category) ranges per IP family from every list file in directory"""
+    ranges = {4: [], 6: []}
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if not os.path.isfile(path) or name.startswith('.'):
+            continue
+        category = os.path.splitext(name)[0]
+        with open(path, encoding='utf-8', errors='replace') as f:
+            for line in f:
+                entry = line.split('#', 1)[0].split(';', 1)[0].strip()
+                if not entry:
+                    continue
+                try:
+                    network = ipaddress.ip_network(entry, strict=False)
+                except ValueError:
+                    logger.warning(f"Skipping invalid entry {entry!r} in {path}")
+                    continue
+                ranges[network.version].append(
+                    (int(network.network_address), int(network.broadcast_address), category)
+                )
+    return ranges
+
+
+def list_signature(directory):
+    """Names, sizes and mtimes of the list files, to tell when any changed"""
+    if not os.path.isdir(directory):
+        return None
+    signature = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and not name.startswith('.'):
+            stat = os.stat(path)
+            signature.append((name, stat.st_size, stat.st_mtime))
+    return tuple(signature)
+
+
+class ReputationIndex:
+    """Immutable IPv4 and IPv6 range tables built from one read of the lists"""
+
+    def __init__(self, ranges):
+        self.v4 = RangeTable(ranges[4], wide=False)
+        self.v6 = RangeTable(ranges[6], wide=True)
+        self.built_at = datetime.utcnow()
+
+    @classmethod
+    def build(cls, directory):
+        return cls(read_lists(directory))
+
+    def lookup(self, ip):
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return ()
+        if address.version == 6:
+            if address.ipv4_mapped is not None:
+                return self.v4.lookup(int(address.ipv4_mapped))
+            return self.v6.lookup(int(address))
+        return self.v4.lookup(int(address))
+
+
+class IPReputation:
+    """Offline VPN, hosting and datacenter range lookups.
+
+    Each file in IP_REPUTATION_DIR holds CIDRs or addresses, one per line,
+    and names a category after itself. The lists are compiled into sorted,
+    disjoint interval tables answered by bisect, so a lookup takes
+    microseconds and needs no network. The directory is rechecked every
+    IP_REPUTATION_RELOAD_INTERVAL seconds; changed lists are rebuilt in a
+    worker thread and the new index swapped in with one assignment, so
+    lookups never see a half-built table.
+    """
+
+    def __init__(self, directory=IP_REPUTATION_DIR):
+        self.directory = directory
+        self.index = ReputationIndex({4: [], 6: []})
+        self.signature = None
+        self.lookups = 0
+        self.matches = 0
+        self.reloads = 0
+        metrics.register("ip_reputation", self.stats)
+
+    def start(self):
+        asyncio.create_task(self._reload_loop())
+
+    def lookup(self, ip):
+        """Categories whose lists cover ip; empty if none do"""
+        self.lookups += 1
+        categories = self.index.lookup(ip)
+        if categories:
+            self.matches += 1
+        return categories
+
+    async def reload(self):
+        """Rebuild the index if the list files changed; True if it was swapped"""
+        signature = await asyncio.to_thread(list_signature, self.directory)
+        if signature == self.signature:
+            return False
+        if signature is None:
+            # The directory went away; stop matching its old lists
+            index = ReputationIndex({4: [], 6: []})
+        else:
+            index = await asyncio.to_thread(ReputationIndex.build, self.directory)
+        self.index = index
+        self.signature = signature
+        self.reloads += 1
+        logger.info(f"Loaded IP reputation lists: {len(index.v4)} IPv4 and {len(index.v6)} IPv6 ranges")
+        return True
+
+    async def _reload_loop(self):
+        while True:
+            try:
+                await self.reload()
+            except Exception as e:
+                logger.error(f"Error loading IP reputation lists: {e}")
+            await asyncio.sleep(IP_REPUTATION_RELOAD_INTERVAL)
+
+    def stats(self):
+        return {
+            "ipv4_ranges": len(self.index.v4),
+            "ipv6_ranges": len(self.index.v6),
+            "built_at": self.index.built_at.isoformat(),
+            "lookups": self.lookups,
+            "matches": self.matches,
+            "reloads": self.reloads
+        }
@@ -0,0 +1,55 @@
+import codecs
+import os
+import zlib
+
+LOG_CHUNK_SIZE = int(os.getenv('LOG_SCAN_CHUNK_SIZE', 256 * 1024))
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+class ChunkDecoder:
+    """Turns raw log bytes, gzip-compressed or not, into text chunks.
+
+    Decompression is capped at chunk_size per step, so a small compressed
+    payload can't expand into one huge string.
+    """
+
+    def __init__(self, chunk_size=LOG_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.decompressor = None
+        self.started = False
+        self.text = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    def feed(self, data):
+        if not self.started:
+            self.started = True
+            if data[:2] == GZIP_MAGIC:
+                self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        if self.decompressor is None:
+            yield self.text.decode(data)
+            return
+
+        while data:
+            yield self.text.decode(self.decompressor.decompress(data, self.chunk_size))
+            data = self.decompressor.unconsumed_tail
+
+    def flush(self):
+        tail = self.decompressor.flush() if self.decompressor is not None else b''
+        return self.text.decode(tail, final=True)
+
+
+def iter_content_chunks(content, chunk_size=LOG_CHUNK_SIZE):
+    """Yield inline log content (str, bytes or gzip bytes) as text chunks"""
+    if isinstance(content, str):
+        for start in range(0, len(content), chunk_size):
+            yield content[start:start + chunk_size]
+        return
+
+    decoder = ChunkDecoder(chunk_size)
+    for start in range(0, len(content), chunk_size):
+        yield from decoder.feed(bytes(content[start:start + chunk_size]))
+    yield decoder.flush()
+
+
+def has_content(log_doc):
+    return bool(log_doc.get('content')) or log_doc.get('content_file_id') is not None
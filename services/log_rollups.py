@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import os
+import zlib
+from datetime import datetime, timedelta
+
+from pymongo import UpdateOne
+
+from services.log_scanner import ERROR_PATTERNS, LOG_TYPES
+from services.log_templates import TOP_TEMPLATES
+
+logger = logging.getLogger('log_rollups')
+
+LOG_ROLLUP_FLUSH_INTERVAL = int(os.getenv('LOG_ROLLUP_FLUSH_INTERVAL', 10))
+HOUR = timedelta(hours=1)
+
+
+def floor_hour(timestamp):
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+def ceil_hour(timestamp):
+    floored = floor_hour(timestamp)
+    return floored if floored == timestamp else floored + HOUR
+
+
+class LogRollups:
+    """Hourly, per-source counts of log types and error patterns.
+
+    Each analysed log increments an in-memory bucket; buckets are upserted
+    into log_rollups with $inc in one unordered bulk_write per flush. Each
+    log's most frequent line templates are counted too, keyed by the crc32
+    of their text since templates can't be used as field names. The
+    log_rollup_state document records the first hour the rollups fully
+    cover, so older windows know to fall back to the raw logs.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.since = None
+        # (hour, source) -> {field path: increment}
+        self.pending = {}
+        # (hour, source) -> {field path: template text}
+        self.pending_texts = {}
+
+    async def start(self):
+        # The current hour is only partly covered, so coverage starts at the next one
+        await self.db.log_rollup_state.update_one(
+            {"_id": "coverage"},
+            {"$setOnInsert": {"since": floor_hour(datetime.utcnow()) + HOUR}},
+            upsert=True
+        )
+        state = await self.db.log_rollup_state.find_one({"_id": "coverage"})
+        self.since = state['since']
+        asyncio.create_task(self._flush_loop())
+
+    def add(self, log_doc, log_type, patterns, templates=None):
+        """Count one analysed log in its hour's bucket"""
+        timestamp = log_doc.get('timestamp')
+        if not isinstance(timestamp, datetime):
+            return
+        key = (floor_hour(timestamp), log_doc.get('source', 'Unknown'))
+        bucket = self.pending.setdefault(key, {})
+        bucket['docs'] = bucket.get('docs', 0) + 1
+        if log_type:
+            field = f"log_types.{log_type}"
+            bucket[field] = bucket.get(field, 0) + 1
+        for pattern in patterns:
+            field = f"error_patterns.{pattern}"
+            bucket[field] = bucket.get(field, 0) + 1
+        for template, count in (templates or {}).items():
+            field = f"templates.{zlib.crc32(template.encode()):08x}"
+            bucket[f"{field}.n"] = bucket.get(f"{field}.n", 0) + count
+            self.pending_texts.setdefault(key, {})[f"{field}.t"] = template
+
+    async def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        texts, self.pending_texts = self.pending_texts, {}
+        requests = []
+        for (hour, source), increments in pending.items():
+            update = {"$inc": increments, "$setOnInsert": {"hour": hour, "source": source}}
+            if (hour, source) in texts:
+                update["$set"] = texts[(hour, source)]
+            requests.append(UpdateOne({"_id": {"hour": hour, "source": source}}, update, upsert=True))
+        try:
+            await self.db.log_rollups.bulk_write(requests, ordered=False)
+        except Exception:
+            # Put the counts back so the next flush retries them
+            for key, increments in pending.items():
+                bucket = self.pending.setdefault(key, {})
+                for field, count in increments.items():
+                    bucket[field] = bucket.get(field, 0) + count
+            for key, fields in texts.items():
+                self.pending_texts.setdefault(key, {}).update(fields)
+            raise
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(LOG_ROLLUP_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing log rollups: {e}")
+
+    async def totals(self, start, end):
+        """Summed log types, error patterns and top templates for the hour buckets in [start, end)"""
+        await self.flush()
+        group = {'_id': None}
+        for log_type, _ in LOG_TYPES:
+            group[f"log_types_{log_type}"] = {'$sum': f"$log_types.{log_type}"}
+        for pattern in ERROR_PATTERNS:
+            group[f"error_patterns_{pattern}"] = {'$sum': f"$error_patterns.{pattern}"}
+
+        pipeline = [{'$match': {'hour': {'$gte': start, '$lt': end}}}, {'$group': group}]
+        result = await self.db.log_rollups.aggregate(pipeline).to_list(length=1)
+        row = result[0] if result else {}
+        log_types = {log_type: row.get(f"log_types_{log_type}", 0) for log_type, _ in LOG_TYPES}
+        error_patterns = {pattern: row.get(f"error_patterns_{pattern}", 0) for pattern in ERROR_PATTERNS}
+
+        pipeline = [
+            {'$match': {'hour': {'$gte': start, '$lt': end}, 'templates': {'$exists': True}}},
+            {'$project': {'templates': {'$objectToArray': '$templates'}}},
+            {'$unwind': '$templates'},
+            {'$group': {
+                '_id': '$templates.k',
+                'count': {'$sum': '$templates.v.n'},
+                'template': {'$first': '$templates.v.t'}
+            }},
+            {'$sort': {'count': -1}},
+            {'$limit': TOP_TEMPLATES}
+        ]
+        rows = await self.db.log_rollups.aggregate(pipeline).to_list(length=TOP_TEMPLATES)
+        templates = {row['template']: row['count'] for row in rows if row.get('template')}
+        return log_types, error_patterns, templates
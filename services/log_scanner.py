@@ -0,0 +1,233 @@
+import os
+import re
+
+# Categories reported for each inserted log
+SUMMARY_CATEGORIES = {
+    'errors': ('error', 'exception', 'failed', 'crash'),
+    'warnings': ('warning', 'warn'),
+    'connections': ('connect', 'disconnect', 'join', 'leave'),
+    'security': ('hack', 'cheat', 'exploit', 'inject'),
+    'performance': ('lag', 'timeout', 'slow', 'performance'),
+}
+
+# How !analyze_logs classifies a whole log; the first matching type wins
+LOG_TYPES = (
+    ('errors', ('error', 'exception')),
+    ('warnings', ('warning',)),
+    ('connections', ('connect', 'disconnect')),
+)
+ERROR_PATTERNS = ('timeout', 'crash', 'failed', 'invalid')
+
+MAX_CONTEXTS = int(os.getenv('LOG_SCAN_MAX_CONTEXTS', 3))
+CONTEXT_CHARS = 50
+
+
+class ScanResult:
+    """Match counts per category and term, plus the first few matches' context.
+
+    A scan over a string keeps only match positions and slices the context
+    when asked for; a streamed scan has no text to slice later, so it keeps
+    the context strings themselves.
+    """
+
+    __slots__ = ('text', 'counts', 'terms', 'spans', 'samples', 'templates', 'flagged')
+
+    def __init__(self, text=None):
+        self.text = text
+        self.counts = {}
+        self.terms = {}
+        # category -> [(start, end), ...], capped at the scanner's max_contexts
+        self.spans = {}
+        # category -> [context, ...] for streamed scans
+        self.samples = {}
+        # Line templates of a mined scan: template -> occurrences, and the
+        # templates whose lines matched a keyword
+        self.templates = {}
+        self.flagged = set()
+
+    def __bool__(self):
+        return bool(self.counts)
+
+    def merge(self, other, max_contexts=MAX_CONTEXTS):
+        """Add another streamed scan's counts and samples into this one"""
+        for category, count in other.counts.items():
+            self.counts[category] = self.counts.get(category, 0) + count
+        for term, count in other.terms.items():
+            self.terms[term] = self.terms.get(term, 0) + count
+        for category, samples in other.samples.items():
+            mine = self.samples.setdefault(category, [])
+            mine.extend(samples[:max(0, max_contexts - len(mine))])
+
+    def contexts(self, category, width=CONTEXT_CHARS):
+        """Text around each recorded match, sliced only when asked for"""
+        if self.text is None:
+            return list(self.samples.get(category, ()))
+        return [
+            self.text[max(0, start - width):end + width].strip()
+            for start, end in self.spans.get(category, ())
+        ]
+
+
+class LogScanner:
+    """Scans log text for every category's keywords in a single regex pass.
+
+    All terms are compiled into one alternation factored as a prefix trie, so
+    the engine tests one character per position instead of every term. The
+    text is lowercased once up front, and each matched term maps straight to
+    the categories it belongs to, so registering another category adds no
+    extra passes.
+    """
+
+    def __init__(self, categories=None, max_contexts=MAX_CONTEXTS):
+        self.max_contexts = max_contexts
+        self.categories = {}
+        self._regex = None
+        self._regex_ignorecase = None
+        self._term_categories = None
+        for category, terms in (categories or {}).items():
+            self.register(category, terms)
+
+    def register(self, category, terms):
+        """Add (or extend) a category of case-insensitive literal keywords"""
+        existing = self.categories.setdefault(category, [])
+        existing.extend(term.lower() for term in terms if term.lower() not in existing)
+        self._regex = None
+
+    def _compile(self):
+        term_categories = {}
+        for category, terms in self.categories.items():
+            for term in terms:
+                term_categories.setdefault(term, []).append(category)
+
+        # (?!) never matches, for a scanner with no terms yet
+        pattern = trie_pattern(term_categories) or '(?!)'
+        self._regex = re.compile(pattern)
+        self._regex_ignorecase = re.compile(pattern, re.IGNORECASE)
+        self._term_categories = term_categories
+        self.max_term_length = max(map(len, term_categories), default=0)
+
+    def _finditer(self, text, pos=0):
+        if self._regex is None:
+            self._compile()
+        lowered = text.lower()
+        if len(lowered) == len(text):
+            return self._regex.finditer(lowered, pos)
+        # A few characters change length when lowercased; keep spans aligned
+        return self._regex_ignorecase.finditer(text, pos)
+
+    def _record(self, result, match):
+        """Count a match; return the categories still collecting context"""
+        term = match.group().lower()
+        result.terms[term] = result.terms.get(term, 0) + 1
+        sampling = []
+        for category in self._term_categories[term]:
+            count = result.counts.get(category, 0)
+            result.counts[category] = count + 1
+            if count < self.max_contexts:
+                sampling.append(category)
+        return sampling
+
+    def scan(self, text):
+        """Scan a string held in memory"""
+        result = ScanResult(text)
+        for match in self._finditer(text):
+            for category in self._record(result, match):
+                result.spans.setdefault(category, []).append(match.span())
+        return result
+
+    def stream(self, result=None):
+        """Start a chunked scan whose memory use doesn't depend on the log size"""
+        if self._regex is None:
+            self._compile()
+        return StreamScan(self, result=result)
+
+    def count_terms(self, text):
+        """Occurrences of each matched term in text, without recording context"""
+        counts = {}
+        for match in self._finditer(text):
+            term = match.group().lower()
+            counts[term] = counts.get(term, 0) + 1
+        return counts
+
+
+class StreamScan:
+    """Scans text fed in chunks, keeping only counts and capped context samples.
+
+    Matches too close to the end of a chunk are deferred until the next one
+    arrives, and a short tail is carried over, so terms and their context
+    that straddle a chunk boundary are neither lost nor counted twice.
+    """
+
+    def __init__(self, scanner, width=CONTEXT_CHARS, result=None):
+        self.scanner = scanner
+        self.width = width
+        # Room a deferred match needs: the longest term plus its right context
+        self.lookahead = scanner.max_term_length + width
+        self.result = result if result is not None else ScanResult()
+        self.buffer = ''
+        self.position = 0
+
+    def feed(self, chunk):
+        self._scan(self.buffer + chunk, final=False)
+
+    def finish(self):
+        self._scan(self.buffer, final=True)
+        self.buffer = ''
+        return self.result
+
+    def _scan(self, buffer, final):
+        limit = len(buffer) if final else len(buffer) - self.lookahead
+        resume = self.position
+        if limit > self.position:
+            resume = limit
+            for match in self.scanner._finditer(buffer, self.position):
+                start, end = match.span()
+                if start >= limit:
+                    break
+                for category in self.scanner._record(self.result, match):
+                    context = buffer[max(0, start - self.width):end + self.width].strip()
+                    self.result.samples.setdefault(category, []).append(context)
+                resume = max(end, limit)
+
+        # Keep just enough text before the resume point for left context
+        keep_from = max(0, resume - self.width)
+        self.buffer = buffer[keep_from:]
+        self.position = resume - keep_from
+
+
+def trie_pattern(terms):
+    """Regex matching any of terms, longest first, factored by common prefix"""
+    root = {}
+    for term in terms:
+        node = root
+        for char in term:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def build(node):
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        # A term ending here is only taken if no longer term continues
+        return f"(?:{body})?" if '' in node else body
+
+    return build(root)
+
+
+def default_scanner():
+    """Scanner covering the live summary categories and !analyze_logs patterns"""
+    scanner = LogScanner(SUMMARY_CATEGORIES)
+    scanner.register('error_patterns', ERROR_PATTERNS)
+    return scanner
+
+
+def classify(result):
+    """Return the !analyze_logs log type (or None) and the error patterns present"""
+    log_type = None
+    for name, terms in LOG_TYPES:
+        if any(term in result.terms for term in terms):
+            log_type = name
+            break
+    patterns = [pattern for pattern in ERROR_PATTERNS if pattern in result.terms]
+    return log_type, patterns
@@ -0,0 +1,335 @@
+import heapq
+import os
+import re
+from collections import OrderedDict
+
+from services.log_scanner import CONTEXT_CHARS, ScanResult
+
+LOG_TEMPLATE_MAX_CLUSTERS = int(os.getenv('LOG_TEMPLATE_MAX_CLUSTERS', 5000))
+LOG_TEMPLATE_SIMILARITY = float(os.getenv('LOG_TEMPLATE_SIMILARITY', 0.5))
+# Longer lines aren't mined, just streamed through the scanner
+LOG_TEMPLATE_MAX_LINE = int(os.getenv('LOG_TEMPLATE_MAX_LINE', 4096))
+# Leading tokens a line is routed by, and the fan-out allowed per tree node
+TEMPLATE_DEPTH = 3
+TEMPLATE_MAX_CHILDREN = 100
+# Templates kept per scan result
+TOP_TEMPLATES = 10
+
+WILDCARD = '<*>'
+# Tokens holding a digit are variables: numbers, IPs, ports, hex ids, UUIDs,
+# timestamps; so are long runs of hex digits that happen to have none
+_VARIABLE = re.compile(r'(?<!\S)(?:\S*\d\S*|(?:0x)?[0-9a-fA-F]{16,}(?!\S))')
+_LEAF = ''
+
+
+def mask(line):
+    """A line's tokens with the variable ones replaced by <*>"""
+    return _VARIABLE.sub(WILDCARD, line).split()
+
+
+class LogCluster:
+    """A line template and how many lines it has absorbed"""
+
+    __slots__ = ('id', 'tokens', 'path', 'count', 'terms', 'variables')
+
+    def __init__(self, cluster_id, tokens, path):
+        self.id = cluster_id
+        self.tokens = tokens
+        self.path = path
+        self.count = 0
+        # Keyword counts in the constant tokens, cached until the template changes
+        self.terms = None
+        self.variables = [i for i, token in enumerate(tokens) if token == WILDCARD]
+
+    @property
+    def template(self):
+        return ' '.join(self.tokens)
+
+
+class TemplateMiner:
+    """Drain-style online clustering of log lines into templates.
+
+    Lines are routed through a fixed-depth tree keyed by their token count
+    and first few tokens, so each one is compared with only the handful of
+    clusters in its leaf. A line similar enough to one of them is merged in,
+    the tokens that differ becoming <*>; otherwise it starts a new cluster.
+    Clusters are kept in LRU order, and beyond max_clusters the least
+    recently seen is dropped along with any tree nodes left empty.
+    """
+
+    def __init__(self, max_clusters=LOG_TEMPLATE_MAX_CLUSTERS, similarity=LOG_TEMPLATE_SIMILARITY,
+                 depth=TEMPLATE_DEPTH, max_children=TEMPLATE_MAX_CHILDREN):
+        self.max_clusters = max_clusters
+        self.similarity = similarity
+        self.depth = depth
+        self.max_children = max_children
+        self.root = {}
+        self.clusters = OrderedDict()
+        self.evicted = 0
+        self._next_id = 0
+
+    def add(self, line):
+        """Cluster one line and return its cluster"""
+        return self.add_masked(mask(line))
+
+    def add_masked(self, masked, count=1):
+        """Cluster count lines already masked to the same tokens"""
+        path, leaf = self._leaf(masked)
+        cluster, covered = self._match(leaf, masked)
+        if cluster is None:
+            cluster = LogCluster(self._next_id, masked, path)
+            self._next_id += 1
+            leaf.append(cluster)
+            self.clusters[cluster.id] = cluster
+            if len(self.clusters) > self.max_clusters:
+                self._evict()
+        else:
+            if not covered:
+                self._merge(cluster, masked)
+            self.clusters.move_to_end(cluster.id)
+        cluster.count += count
+        return cluster
+
+    def _leaf(self, masked):
+        path = [len(masked)]
+        node = self.root.setdefault(len(masked), {})
+        for token in masked[:self.depth]:
+            if token not in node and len(node) >= self.max_children:
+                # A crowded node sends anything new down its wildcard branch
+                token = WILDCARD
+            node = node.setdefault(token, {})
+            path.append(token)
+        return tuple(path), node.setdefault(_LEAF, [])
+
+    def _match(self, leaf, masked):
+        """Most similar cluster in the leaf, and whether its template already fits the line"""
+        best = None
+        best_score = None
+        covered = False
+        for cluster in leaf:
+            same = wildcards = 0
+            for mine, theirs in zip(cluster.tokens, masked):
+                if mine == WILDCARD:
+                    wildcards += 1
+                elif mine == theirs:
+                    same += 1
+            # Ties go to the more general template
+            score = (same / len(masked), wildcards)
+            if score[0] >= self.similarity and (best_score is None or score > best_score):
+                best, best_score = cluster, score
+                covered = same + wildcards == len(masked)
+        return best, covered
+
+    def _merge(self, cluster, masked):
+        changed = False
+        for i, (mine, theirs) in enumerate(zip(cluster.tokens, masked)):
+            if mine != theirs and mine != WILDCARD:
+                cluster.tokens[i] = WILDCARD
+                changed = True
+        if changed:
+            cluster.terms = None
+            cluster.variables = [i for i, token in enumerate(cluster.tokens) if token == WILDCARD]
+
+    def _evict(self):
+        _, cluster = self.clusters.popitem(last=False)
+        self.evicted += 1
+        nodes = [self.root]
+        for key in cluster.path:
+            nodes.append(nodes[-1][key])
+        leaf = nodes[-1][_LEAF]
+        leaf.remove(cluster)
+        if leaf:
+            return
+        del nodes[-1][_LEAF]
+        # Prune the branch back up to the first node still in use
+        for parent, key, node in zip(reversed(nodes[:-1]), reversed(cluster.path), reversed(nodes[1:])):
+            if node:
+                break
+            del parent[key]
+
+    def stats(self):
+        return {'clusters': len(self.clusters), 'evicted': self.evicted}
+
+
+class MaskedLines:
+    """Groups lines by their exact masked tokens, in place of a TemplateMiner.
+
+    Worker processes scan with this and hand the groups back, so templates
+    are only ever mined by the parent's one TemplateMiner and every path
+    reports and rolls up the same ones.
+    """
+
+    def __init__(self):
+        self.groups = {}
+
+    def add(self, line):
+        masked = mask(line)
+        key = tuple(masked)
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = LogCluster(len(self.groups), masked, key)
+        group.count += 1
+        return group
+
+    def lines(self, flagged=()):
+        """[(tokens, lines, whether any matched a keyword)] per group"""
+        return [(key, group.count, group in flagged) for key, group in self.groups.items()]
+
+
+def cluster_lines(miner, lines, clusters, flagged):
+    """Mine MaskedLines groups into miner, adding lines per cluster and the flagged clusters"""
+    for tokens, count, matched in lines:
+        cluster = miner.add_masked(list(tokens), count)
+        clusters[cluster] = clusters.get(cluster, 0) + count
+        if matched:
+            flagged.add(cluster)
+
+
+def top_templates(clusters, limit=TOP_TEMPLATES):
+    """Template -> lines for the limit clusters with the most lines"""
+    templates = {}
+    for cluster, count in heapq.nlargest(limit, clusters.items(), key=lambda item: item[1]):
+        templates[cluster.template] = templates.get(cluster.template, 0) + count
+    return templates
+
+
+class TemplateScan:
+    """Scans log text fed in chunks line by line, through a TemplateMiner.
+
+    A template's constant tokens are scanned once and the counts kept on its
+    cluster, so a recurring line costs a tree lookup plus a scan of just its
+    variable tokens; the constant counts are tallied per template and only
+    added up in finish(). Keywords never contain whitespace, so counting per
+    token gives the same totals as scanning the whole text. Context samples
+    are taken from at most one line per template. Lines longer than max_line
+    aren't mined; they're streamed through the plain scanner in pieces.
+    """
+
+    def __init__(self, scanner, miner, max_line=LOG_TEMPLATE_MAX_LINE, width=CONTEXT_CHARS):
+        self.scanner = scanner
+        self.miner = miner
+        self.max_line = max_line
+        self.width = width
+        self.result = ScanResult()
+        self.partial = ''
+        # StreamScan of a line too long to mine, while it is being read
+        self.long_line = None
+        # cluster -> lines of this log it absorbed
+        self.clusters = {}
+        # id(cluster.terms) -> [terms, lines]; a template that changes gets a new dict
+        self.constant = {}
+        # Clusters whose lines matched a keyword, already sampled for context
+        self.flagged = set()
+
+    def feed(self, chunk):
+        lines = (self.partial + chunk).split('\n')
+        self.partial = lines.pop()
+        for line in lines:
+            if self.long_line is not None:
+                self.long_line.feed(line)
+                self._end_long_line()
+            else:
+                self._line(line)
+        if len(self.partial) > self.max_line:
+            if self.long_line is None:
+                self.long_line = self.scanner.stream(result=self.result)
+            self.long_line.feed(self.partial)
+            self.partial = ''
+
+    def finish(self):
+        if self.long_line is not None:
+            self.long_line.feed(self.partial)
+            self._end_long_line()
+        elif self.partial:
+            self._line(self.partial)
+        self.partial = ''
+
+        for terms, lines in self.constant.values():
+            self._count(terms, lines)
+        self.constant = {}
+
+        top = heapq.nlargest(TOP_TEMPLATES, self.clusters.items(), key=lambda item: item[1])
+        for cluster, count in top:
+            template = cluster.template
+            self.result.templates[template] = self.result.templates.get(template, 0) + count
+        self.result.flagged = {cluster.template for cluster in self.flagged}
+        return self.result
+
+    def _end_long_line(self):
+        self.long_line.finish()
+        self.long_line = None
+
+    def _line(self, line):
+        if len(line) > self.max_line:
+            self.long_line = self.scanner.stream(result=self.result)
+            self.long_line.feed(line)
+            self._end_long_line()
+            return
+        if not line or line.isspace():
+            return
+
+        cluster = self.miner.add(line)
+        self.clusters[cluster] = self.clusters.get(cluster, 0) + 1
+        if cluster.terms is None:
+            cluster.terms = self.scanner.count_terms(
+                ' '.join(token for token in cluster.tokens if token != WILDCARD)
+            )
+        if cluster.terms:
+            tally = self.constant.get(id(cluster.terms))
+            if tally is None:
+                tally = self.constant[id(cluster.terms)] = [cluster.terms, 0]
+            tally[1] += 1
+
+        variable = None
+        if cluster.variables:
+            tokens = line.split()
+            variable = self.scanner.count_terms(' '.join(tokens[i] for i in cluster.variables))
+            if variable:
+                self._count(variable, 1)
+
+        if (cluster.terms or variable) and cluster not in self.flagged:
+            self.flagged.add(cluster)
+            self._sample(line)
+
+    def _count(self, terms, lines):
+        result = self.result
+        term_categories = self.scanner._term_categories
+        for term, count in terms.items():
+            count *= lines
+            result.terms[term] = result.terms.get(term, 0) + count
+            for category in term_categories[term]:
+                result.counts[category] = result.counts.get(category, 0) + count
+
+    def _sample(self, line):
+        """Record context for the categories still short of samples"""
+        samples = self.result.samples
+        term_categories = self.scanner._term_categories
+        for match in self.scanner._finditer(line):
+            start, end = match.span()
+            for category in term_categories[match.group().lower()]:
+                category_samples = samples.setdefault(category, [])
+                if len(category_samples) < self.scanner.max_contexts:
+                    category_samples.append(line[max(0, start - self.width):end + self.width].strip())
+
+
+def merge_templates(templates, more, limit=None):
+    """Add one result's template counts into another, keeping the top limit"""
+    for template, count in more.items():
+        templates[template] = templates.get(template, 0) + count
+    if limit is not None and len(templates) > limit:
+        keep = dict(heapq.nlargest(limit, templates.items(), key=lambda item: item[1]))
+        templates.clear()
+        templates.update(keep)
+    return templates
+
+
+def format_templates(templates, limit=5, width=80):
+    """Embed lines reporting the most frequent templates, "`template` ×N" """
+    top = heapq.nlargest(limit, templates.items(), key=lambda item: item[1])
+    lines = []
+    for template, count in top:
+        template = template.replace('`', "'")
+        if len(template) > width:
+            template = template[:width - 1] + '…'
+        lines.append(f"• `{template}` ×{count:,}")
+    return "\n".join(lines)
@@ -0,0 +1,201 @@
+import asyncio
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from services.log_content import iter_content_chunks
+from services.log_scanner import ScanResult, classify, default_scanner
+from services.log_templates import (
+    TOP_TEMPLATES, MaskedLines, TemplateScan, cluster_lines, merge_templates, top_templates
+)
+
+LOG_ANALYSIS_WORKERS = int(os.getenv('LOG_ANALYSIS_WORKERS', os.cpu_count() or 1))
+LOG_ANALYSIS_MAX_INFLIGHT = int(os.getenv('LOG_ANALYSIS_MAX_INFLIGHT', LOG_ANALYSIS_WORKERS * 2))
+LOG_ANALYSIS_BATCH_BYTES = int(os.getenv('LOG_ANALYSIS_BATCH_BYTES', 4 * 1024 * 1024))
+LOG_ANALYSIS_BATCH_DOCS = 500
+# Logs smaller than this are cheaper to scan in place than to ship to a worker
+LOG_POOL_MIN_BYTES = int(os.getenv('LOG_POOL_MIN_BYTES', 64 * 1024))
+
+# Each worker process builds its own scanner on first use. Workers don't
+# mine templates: they group lines by their masked tokens and the parent
+# clusters those with its own miner, so templates are the same on every path
+_scanner = None
+
+
+def _worker_scanner():
+    global _scanner
+    if _scanner is None:
+        _scanner = default_scanner()
+    return _scanner
+
+
+def scan_content(content, scanner, miner):
+    """Scan inline log content (str, bytes or gzip bytes) line template by line template"""
+    scan = TemplateScan(scanner, miner)
+    for chunk in iter_content_chunks(content):
+        scan.feed(chunk)
+    return scan.finish()
+
+
+def scan_lines(content):
+    """Worker entry point: scan one log's content, returning the result and its line groups"""
+    groups = MaskedLines()
+    scan = TemplateScan(_worker_scanner(), groups)
+    for chunk in iter_content_chunks(content):
+        scan.feed(chunk)
+    return scan.finish(), groups.lines(scan.flagged)
+
+
+def classify_batch(contents):
+    """Worker entry point: log-type and error-pattern counts and line groups for a batch of logs"""
+    stats = {}
+    error_patterns = {}
+    groups = MaskedLines()
+    for content in contents:
+        result = scan_content(content, _worker_scanner(), groups)
+        log_type, patterns = classify(result)
+        if log_type:
+            stats[log_type] = stats.get(log_type, 0) + 1
+        for pattern in patterns:
+            error_patterns[pattern] = error_patterns.get(pattern, 0) + 1
+    return stats, error_patterns, groups.lines()
+
+
+def mined(result, clusters, flagged):
+    """Set a worker result's templates from the parent's clusters of its lines"""
+    result.templates = top_templates(clusters)
+    result.flagged = {cluster.template for cluster in flagged}
+    return result
+
+
+class LogAnalysisPool:
+    """Runs CPU-bound log scanning in worker processes, off the event loop.
+
+    Documents are grouped into batches of about LOG_ANALYSIS_BATCH_BYTES,
+    and at most LOG_ANALYSIS_MAX_INFLIGHT batches are queued at once, so a
+    huge analysis pulls from Mongo only as fast as the workers keep up.
+    """
+
+    def __init__(self, workers=LOG_ANALYSIS_WORKERS, max_inflight=LOG_ANALYSIS_MAX_INFLIGHT):
+        # spawn: forking a process that runs threads (Motor, Flask) isn't safe
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn')
+        )
+        self.max_inflight = max_inflight
+
+    async def scan(self, content, scanner, miner):
+        """Scan one log's inline content, in a worker if it is large; templates come from miner"""
+        if len(content) < LOG_POOL_MIN_BYTES:
+            return scan_content(content, scanner, miner)
+        loop = asyncio.get_running_loop()
+        result, lines = await loop.run_in_executor(self.executor, scan_lines, content)
+        clusters = {}
+        flagged = set()
+        cluster_lines(miner, lines, clusters, flagged)
+        return mined(result, clusters, flagged)
+
+    async def scan_stream(self, chunks, scanner, miner):
+        """Scan one log's text from an async iterator of chunks, a segment per worker task.
+
+        Segments are cut at line ends every LOG_ANALYSIS_BATCH_BYTES and at
+        most max_inflight are out at once, so memory stays bounded whatever
+        the log's size; their results are merged back in log order, and
+        their lines mined with miner.
+        """
+        loop = asyncio.get_running_loop()
+        pending = deque()
+        result = ScanResult()
+        clusters = {}
+        flagged = set()
+
+        def merge(scanned):
+            segment, lines = scanned
+            result.merge(segment, scanner.max_contexts)
+            cluster_lines(miner, lines, clusters, flagged)
+
+        async def submit(segment):
+            if len(pending) >= self.max_inflight:
+                merge(await pending.popleft())
+            pending.append(loop.run_in_executor(self.executor, scan_lines, segment))
+
+        try:
+            parts = []
+            size = 0
+            async for chunk in chunks:
+                parts.append(chunk)
+                size += len(chunk)
+                if size >= LOG_ANALYSIS_BATCH_BYTES:
+                    text = ''.join(parts)
+                    # A line longer than a whole segment is split where it is
+                    cut = text.rfind('\n') + 1 or len(text)
+                    await submit(text[:cut])
+                    parts = [text[cut:]]
+                    size = len(parts[0])
+
+            text = ''.join(parts)
+            if not pending and len(text) < LOG_POOL_MIN_BYTES:
+                return scan_content(text, scanner, miner)
+            if text:
+                await submit(text)
+            while pending:
+                merge(await pending.popleft())
+        finally:
+            for future in pending:
+                future.cancel()
+        return mined(result, clusters, flagged)
+
+    async def classify_logs(self, contents, miner, stats, error_patterns, templates):
+        """Classify every content from an async iterator, merging counts into the given dicts.
+
+        Templates are mined with miner, the same one single logs are scanned with.
+        """
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.max_inflight)
+        pending = set()
+        failures = []
+        clusters = {}
+
+        def merge(future):
+            slots.release()
+            if future.cancelled():
+                return
+            if future.exception():
+                failures.append(future.exception())
+                return
+            batch_stats, batch_patterns, batch_lines = future.result()
+            for log_type, count in batch_stats.items():
+                stats[log_type] += count
+            for pattern, count in batch_patterns.items():
+                error_patterns[pattern] += count
+            cluster_lines(miner, batch_lines, clusters, set())
+
+        async def submit(batch):
+            await slots.acquire()
+            future = loop.run_in_executor(self.executor, classify_batch, batch)
+            future.add_done_callback(merge)
+            pending.add(future)
+            future.add_done_callback(pending.discard)
+
+        batch = []
+        batch_bytes = 0
+        async for content in contents:
+            batch.append(content)
+            batch_bytes += len(content)
+            if batch_bytes >= LOG_ANALYSIS_BATCH_BYTES or len(batch) >= LOG_ANALYSIS_BATCH_DOCS:
+                await submit(batch)
+                batch = []
+                batch_bytes = 0
+        if batch:
+            await submit(batch)
+
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+        # Surface the first worker failure, if any
+        if failures:
+            raise failures[0]
+        merge_templates(templates, top_templates(clusters, TOP_TEMPLATES * 10), limit=TOP_TEMPLATES * 10)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
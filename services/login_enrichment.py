@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import os
+from datetime import datetime
+
+from pymongo import UpdateOne
+
+from services import metrics
+
+logger = logging.getLogger('login_enrichment')
+
+LOGIN_ENRICHMENT_FLUSH_INTERVAL = float(os.getenv('LOGIN_ENRICHMENT_FLUSH_INTERVAL', 5))
+LOGIN_ENRICHMENT_BATCH_SIZE = int(os.getenv('LOGIN_ENRICHMENT_BATCH_SIZE', 500))
+LOGIN_BACKFILL_BATCH_SIZE = int(os.getenv('LOGIN_BACKFILL_BATCH_SIZE', 1000))
+
+BACKFILL_STATE_ID = 'backfill'
+
+
+def enrichment_fields(geo, vpn=None):
+    """The fields stored on a login document; vpn is left out while unknown"""
+    fields = {'country': geo.country, 'enriched_at': datetime.utcnow()}
+    if geo.asn is not None:
+        fields['asn'] = geo.asn
+        fields['as_org'] = geo.as_org
+    if vpn is not None:
+        fields['vpn'] = vpn
+    return fields
+
+
+class LoginEnrichment:
+    """Writes country, ASN and VPN verdicts back onto login_logs documents.
+
+    Live logins are queued by _id and written with $set in one unordered
+    bulk_write every LOGIN_ENRICHMENT_FLUSH_INTERVAL seconds, or as soon as
+    LOGIN_ENRICHMENT_BATCH_SIZE are waiting. backfill() enriches historical
+    documents in _id order from the local GeoIP and IP reputation data only,
+    saving its position in login_enrichment_state after every batch so an
+    interrupted run carries on where it stopped.
+    """
+
+    def __init__(self, db, geoip, ip_reputation):
+        self.db = db
+        self.geoip = geoip
+        self.ip_reputation = ip_reputation
+        # login _id -> fields to $set
+        self.pending = {}
+        self._flushing = None
+        self.backfill_running = False
+
+        self.written = 0
+        self.flushes = 0
+        self.failures = 0
+        metrics.register("login_enrichment", self.stats)
+
+    def start(self):
+        asyncio.create_task(self._flush_loop())
+
+    def add(self, login_id, fields):
+        """Queue fields to be $set on one login document"""
+        self.pending.setdefault(login_id, {}).update(fields)
+        if len(self.pending) >= LOGIN_ENRICHMENT_BATCH_SIZE and self._flushing is None:
+            self._flushing = asyncio.ensure_future(self._flush_soon())
+
+    async def _flush_soon(self):
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"Error writing login enrichment: {e}")
+        finally:
+            self._flushing = None
+
+    async def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        requests = [UpdateOne({'_id': login_id}, {'$set': fields}) for login_id, fields in pending.items()]
+        try:
+            await self.db.login_logs.bulk_write(requests, ordered=False)
+        except Exception:
+            self.failures += 1
+            # Requeue, without overwriting anything newer queued meanwhile
+            for login_id, fields in pending.items():
+                self.pending[login_id] = {**fields, **self.pending.get(login_id, {})}
+            raise
+        self.flushes += 1
+        self.written += len(requests)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(LOGIN_ENRICHMENT_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error writing login enrichment: {e}")
+
+    async def backfill(self, max_documents=None, batch_size=LOGIN_BACKFILL_BATCH_SIZE):
+        """Enrich historical logins from where the last run stopped.
+
+        Returns (documents enriched, finished). Remote VPN verdicts aren't
+        requested here; only addresses on the local lists get a vpn field.
+        """
+        if self.backfill_running:
+            raise RuntimeError("A login backfill is already running")
+        self.backfill_running = True
+        try:
+            state = await self.db.login_enrichment_state.find_one({'_id': BACKFILL_STATE_ID}) or {}
+            last_id = state.get('last_id')
+            enriched = 0
+            while max_documents is None or enriched < max_documents:
+                query = {'enriched_at': {'$exists': False}}
+                if last_id is not None:
+                    query['_id'] = {'$gt': last_id}
+                limit = batch_size if max_documents is None else min(batch_size, max_documents - enriched)
+                logins = await self.db.login_logs.find(
+                    query, {'ip_address': 1}
+                ).sort('_id', 1).limit(limit).to_list(length=limit)
+                if not logins:
+                    return enriched, True
+
+                geo = await self.geoip.lookup_many(
+                    login['ip_address'] for login in logins if login.get('ip_address')
+                )
+                requests = []
+                for login in logins:
+                    ip = login.get('ip_address')
+                    if ip in geo:
+                        vpn = True if self.ip_reputation.lookup(ip) else None
+                        requests.append(UpdateOne({'_id': login['_id']}, {'$set': enrichment_fields(geo[ip], vpn)}))
+                if requests:
+                    await self.db.login_logs.bulk_write(requests, ordered=False)
+
+                last_id = logins[-1]['_id']
+                enriched += len(requests)
+                await self.db.login_enrichment_state.update_one(
+                    {'_id': BACKFILL_STATE_ID},
+                    {'$set': {'last_id': last_id, 'updated_at': datetime.utcnow()},
+                     '$inc': {'enriched': len(requests)}},
+                    upsert=True
+                )
+            return enriched, False
+        finally:
+            self.backfill_running = False
+
+    def stats(self):
+        return {
+            "pending": len(self.pending),
+            "written": self.written,
+            "flushes": self.flushes,
+            "failures": self.failures,
+            "backfill_running": self.backfill_running
+        }
@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import os
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from services import metrics
+
+logger = logging.getLogger('login_profiles')
+
+LOGIN_PROFILE_MAX_USERS = int(os.getenv('LOGIN_PROFILE_MAX_USERS', 20000))
+RECENT_IP_WINDOW = timedelta(hours=24)
+
+
+class LoginProfile:
+    """Everything the detectors need to know about one username's logins"""
+
+    __slots__ = ('hwids', 'ips', 'countries', 'recent_ips')
+
+    def __init__(self):
+        self.hwids = set()
+        # ip -> [first_seen, last_seen]
+        self.ips = {}
+        self.countries = set()
+        # ip -> last_seen, oldest first, trimmed to RECENT_IP_WINDOW
+        self.recent_ips = OrderedDict()
+
+    def add(self, hwid=None, ip=None, country=None, timestamp=None):
+        if hwid:
+            self.hwids.add(hwid)
+        if country and country != "Unknown":
+            self.countries.add(country)
+        if not ip:
+            return
+
+        timestamp = timestamp or datetime.utcnow()
+        seen = self.ips.get(ip)
+        if seen is None:
+            self.ips[ip] = [timestamp, timestamp]
+        else:
+            seen[0] = min(seen[0], timestamp)
+            seen[1] = max(seen[1], timestamp)
+
+        last_seen = self.ips[ip][1]
+        if last_seen >= datetime.utcnow() - RECENT_IP_WINDOW:
+            self.recent_ips[ip] = last_seen
+            self.recent_ips.move_to_end(ip)
+
+    def other_hwids(self, hwid):
+        """Number of HWIDs seen for this user besides hwid"""
+        return len(self.hwids) - (1 if hwid in self.hwids else 0)
+
+    def recent_other_ips(self, ip):
+        """IPs other than ip seen within the last RECENT_IP_WINDOW"""
+        cutoff = datetime.utcnow() - RECENT_IP_WINDOW
+        while self.recent_ips:
+            _, last_seen = next(iter(self.recent_ips.items()))
+            if last_seen >= cutoff:
+                break
+            self.recent_ips.popitem(last=False)
+        return [
+            recent_ip for recent_ip, last_seen in self.recent_ips.items()
+            if recent_ip != ip and last_seen >= cutoff
+        ]
+
+
+class LoginProfileIndex:
+    """Per-username login profiles kept in memory and updated from the login stream.
+
+    A profile is built from one aggregation over the user's history the first
+    time it is needed, then every new login is folded in, so per-login leak
+    and VPN checks are dictionary lookups instead of history scans. The least
+    recently used profiles are evicted once LOGIN_PROFILE_MAX_USERS is hit.
+    """
+
+    def __init__(self, db, max_profiles=LOGIN_PROFILE_MAX_USERS):
+        self.db = db
+        self.max_profiles = max_profiles
+        self.profiles = OrderedDict()
+        self._loading = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        metrics.register("login_profiles", self.stats)
+
+    async def get(self, username):
+        """Return the profile for username, loading it from Mongo if needed"""
+        profile = self.profiles.get(username)
+        if profile is not None:
+            self.hits += 1
+            self.profiles.move_to_end(username)
+            return profile
+
+        # Concurrent callers share a single bootstrap query
+        loading = self._loading.get(username)
+        if loading is None:
+            self.misses += 1
+            loading = self._loading[username] = asyncio.ensure_future(self._bootstrap(username))
+            loading.add_done_callback(lambda _: self._loading.pop(username, None))
+        return await asyncio.shield(loading)
+
+    async def observe(self, login_doc, country=None):
+        """Fold a login document into its user's profile and return the profile"""
+        username = login_doc.get('username')
+        if not username:
+            return None
+        profile = await self.get(username)
+        profile.add(
+            hwid=login_doc.get('hwid'),
+            ip=login_doc.get('ip_address'),
+            country=country or login_doc.get('country'),
+            timestamp=login_doc.get('timestamp')
+        )
+        return profile
+
+    async def _bootstrap(self, username):
+        profile = LoginProfile()
+        pipeline = [
+            {'$match': {'username': username}},
+            {'$group': {
+                '_id': '$ip_address',
+                'first_seen': {'$min': '$timestamp'},
+                'last_seen': {'$max': '$timestamp'},
+                'hwids': {'$addToSet': '$hwid'},
+                'countries': {'$addToSet': '$country'}
+            }}
+        ]
+        async for row in self.db.login_logs.aggregate(pipeline):
+            for hwid in row['hwids']:
+                profile.add(hwid=hwid)
+            for country in row['countries']:
+                profile.add(country=country)
+            if row['_id']:
+                profile.add(ip=row['_id'], timestamp=row['first_seen'])
+                profile.add(ip=row['_id'], timestamp=row['last_seen'])
+
+        self.profiles[username] = profile
+        while len(self.profiles) > self.max_profiles:
+            self.profiles.popitem(last=False)
+            self.evictions += 1
+        return profile
+
+    def stats(self):
+        return {
+            "profiles": len(self.profiles),
+            "max_profiles": self.max_profiles,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
@@ -0,0 +1,435 @@
+import asyncio
+import hashlib
+import logging
+import math
+import os
+import struct
+import sys
+from array import array
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from bson import Binary
+from pymongo import UpdateOne
+
+from services import metrics
+
+logger = logging.getLogger('login_sketches')
+
+LOGIN_SKETCH_CACHE_SIZE = int(os.getenv('LOGIN_SKETCH_CACHE_SIZE', 20000))
+LOGIN_SKETCH_FLUSH_INTERVAL = float(os.getenv('LOGIN_SKETCH_FLUSH_INTERVAL', 30))
+LOGIN_SKETCH_BATCH_SIZE = int(os.getenv('LOGIN_SKETCH_BATCH_SIZE', 500))
+# Login _ids remembered so a retried or replayed login isn't counted twice
+RECENT_LOGINS = 10000
+
+# Horizons (days) distinct counts are reported over; the longest bounds what is kept
+HORIZONS = (7, 30, 90)
+MAX_HORIZON = max(HORIZONS)
+# 2**10 HyperLogLog registers: about 3% standard error
+HLL_PRECISION = 10
+HLL_REGISTERS = 1 << HLL_PRECISION
+# Count-Min sketch for login counts per IP: about 1% of the user's logins over-count
+CMS_WIDTH = 256
+CMS_DEPTH = 4
+TOP_IPS = 10
+
+EPOCH = datetime(1970, 1, 1)
+# Serialized as (register u16, pairs u8) followed by that many (day u16, rank u8)
+_PAIR = struct.Struct('<HB')
+
+
+def day_number(when):
+    return (when - EPOCH).days
+
+
+def hash64(value):
+    return int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), 'little')
+
+
+class SlidingHyperLogLog:
+    """HyperLogLog that answers distinct counts over the last N days.
+
+    Instead of one rank per register, each register keeps (day, rank) pairs
+    where no later day has a rank at least as high, so the maximum over any
+    horizon is the first pair inside it (a sliding HyperLogLog). The lists
+    stay a few entries long, and only registers that were hit are stored,
+    which keeps users with a handful of IPs down to tens of bytes.
+    """
+
+    __slots__ = ('registers',)
+
+    def __init__(self):
+        # register -> [(day, rank)], day ascending and rank descending
+        self.registers = {}
+
+    def add(self, value, day):
+        h = hash64(value)
+        index = h >> (64 - HLL_PRECISION)
+        rest = h & ((1 << (64 - HLL_PRECISION)) - 1)
+        rank = (64 - HLL_PRECISION) - rest.bit_length() + 1
+
+        entries = self.registers.get(index)
+        if entries is None:
+            self.registers[index] = [(day, rank)]
+            return
+        if any(d >= day and r >= rank for d, r in entries):
+            return
+        entries = [(d, r) for d, r in entries if not (d <= day and r <= rank)]
+        entries.append((day, rank))
+        entries.sort()
+        self.registers[index] = entries
+
+    def expire(self, today):
+        """Drop pairs older than the longest horizon"""
+        cutoff = today - MAX_HORIZON + 1
+        for index in list(self.registers):
+            entries = [(d, r) for d, r in self.registers[index] if d >= cutoff]
+            if entries:
+                self.registers[index] = entries
+            else:
+                del self.registers[index]
+
+    def count(self, days, today):
+        """Estimated distinct values added over the last `days` days, today included"""
+        cutoff = today - days + 1
+        total = float(HLL_REGISTERS)
+        zeros = HLL_REGISTERS
+        for entries in self.registers.values():
+            for d, r in entries:
+                if d >= cutoff:
+                    total += 2.0 ** -r - 1.0
+                    zeros -= 1
+                    break
+        if zeros == HLL_REGISTERS:
+            return 0
+        alpha = 0.7213 / (1 + 1.079 / HLL_REGISTERS)
+        estimate = alpha * HLL_REGISTERS * HLL_REGISTERS / total
+        if estimate <= 2.5 * HLL_REGISTERS and zeros:
+            # Linear counting is far more accurate for small cardinalities
+            estimate = HLL_REGISTERS * math.log(HLL_REGISTERS / zeros)
+        return round(estimate)
+
+    def to_bytes(self):
+        parts = []
+        for index in sorted(self.registers):
+            entries = self.registers[index]
+            parts.append(_PAIR.pack(index, len(entries)))
+            parts.extend(_PAIR.pack(d, r) for d, r in entries)
+        return b''.join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        sketch = cls()
+        offset = 0
+        while offset < len(data):
+            index, n = _PAIR.unpack_from(data, offset)
+            offset += _PAIR.size
+            entries = []
+            for _ in range(n):
+                entries.append(_PAIR.unpack_from(data, offset))
+                offset += _PAIR.size
+            sketch.registers[index] = entries
+        return sketch
+
+
+class CountMinSketch:
+    """Fixed-size approximate counter; estimates never undercount"""
+
+    __slots__ = ('counters',)
+
+    def __init__(self, counters=None):
+        self.counters = counters if counters is not None else array('I', bytes(4 * CMS_WIDTH * CMS_DEPTH))
+
+    @staticmethod
+    def _cells(value):
+        h = hash64(value)
+        h1, h2 = h & 0xFFFFFFFF, (h >> 32) | 1
+        return [row * CMS_WIDTH + (h1 + row * h2) % CMS_WIDTH for row in range(CMS_DEPTH)]
+
+    def add(self, value, count=1):
+        """Count value (conservative update) and return its new estimate"""
+        cells = self._cells(value)
+        estimate = min(self.counters[cell] for cell in cells) + count
+        for cell in cells:
+            if self.counters[cell] < estimate:
+                self.counters[cell] = min(estimate, 0xFFFFFFFF)
+        return estimate
+
+    def to_bytes(self):
+        counters = self.counters
+        if sys.byteorder != 'little':
+            counters = array('I', counters)
+            counters.byteswap()
+        return counters.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        counters = array('I')
+        counters.frombytes(data)
+        if sys.byteorder != 'little':
+            counters.byteswap()
+        return cls(counters)
+
+
+class TopIPs:
+    """The user's most used IPs with login counts.
+
+    Counts are exact until more than TOP_IPS different IPs show up; from
+    then on a Count-Min sketch counts every IP and only the TOP_IPS highest
+    estimates are kept by name.
+    """
+
+    __slots__ = ('counts', 'sketch')
+
+    def __init__(self, counts=None, sketch=None):
+        self.counts = counts or {}
+        self.sketch = sketch
+
+    def add(self, ip, count=1):
+        counts = self.counts
+        if self.sketch is None:
+            if ip in counts or len(counts) < TOP_IPS:
+                counts[ip] = counts.get(ip, 0) + count
+                return
+            self.sketch = CountMinSketch()
+            for known, known_count in counts.items():
+                self.sketch.add(known, known_count)
+
+        estimate = self.sketch.add(ip, count)
+        if ip in counts or len(counts) < TOP_IPS:
+            counts[ip] = estimate
+            return
+        smallest = min(counts, key=counts.get)
+        if estimate > counts[smallest]:
+            del counts[smallest]
+            counts[ip] = estimate
+
+    @property
+    def exact(self):
+        return self.sketch is None
+
+    def top(self, limit=TOP_IPS):
+        return sorted(self.counts.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+
+class UserSketch:
+    """Fixed-size summary of one username's logins"""
+
+    __slots__ = ('ips', 'hwids', 'top_ips')
+
+    def __init__(self, ips=None, hwids=None, top_ips=None):
+        self.ips = ips or SlidingHyperLogLog()
+        self.hwids = hwids or SlidingHyperLogLog()
+        self.top_ips = top_ips or TopIPs()
+
+    def add(self, hwid=None, ip=None, day=None, count=1):
+        if hwid:
+            self.hwids.add(hwid, day)
+        if ip:
+            self.ips.add(ip, day)
+            self.top_ips.add(ip, count)
+
+    def distinct_ips(self, days=MAX_HORIZON, today=None):
+        return self.ips.count(days, today if today is not None else day_number(datetime.utcnow()))
+
+    def distinct_hwids(self, days=MAX_HORIZON, today=None):
+        return self.hwids.count(days, today if today is not None else day_number(datetime.utcnow()))
+
+    def horizons(self, kind):
+        """{days: distinct count} for every horizon, for 'ips' or 'hwids'"""
+        today = day_number(datetime.utcnow())
+        sketch = self.ips if kind == 'ips' else self.hwids
+        return {days: sketch.count(days, today) for days in HORIZONS}
+
+    def to_document(self):
+        today = day_number(datetime.utcnow())
+        self.ips.expire(today)
+        self.hwids.expire(today)
+        document = {
+            'ips': Binary(self.ips.to_bytes()),
+            'hwids': Binary(self.hwids.to_bytes()),
+            'top_ips': [[ip, count] for ip, count in self.top_ips.counts.items()],
+            'updated_at': datetime.utcnow()
+        }
+        document['top_ips_sketch'] = (
+            Binary(self.top_ips.sketch.to_bytes()) if self.top_ips.sketch is not None else None
+        )
+        return document
+
+    @classmethod
+    def from_document(cls, document):
+        sketch = document.get('top_ips_sketch')
+        return cls(
+            ips=SlidingHyperLogLog.from_bytes(bytes(document.get('ips') or b'')),
+            hwids=SlidingHyperLogLog.from_bytes(bytes(document.get('hwids') or b'')),
+            top_ips=TopIPs(
+                counts={ip: count for ip, count in document.get('top_ips') or []},
+                sketch=CountMinSketch.from_bytes(bytes(sketch)) if sketch else None
+            )
+        )
+
+
+class LoginSketches:
+    """Per-username login sketches, kept in login_sketches and updated from the login stream.
+
+    A user's sketch is read from login_sketches the first time it is needed,
+    or built once from the last MAX_HORIZON days of login_logs if there is
+    none yet; after that every login is folded in. Changed sketches are
+    written back in one unordered bulk_write every
+    LOGIN_SKETCH_FLUSH_INTERVAL seconds, and the least recently used are
+    dropped from memory past LOGIN_SKETCH_CACHE_SIZE (after being written,
+    if they changed).
+    """
+
+    def __init__(self, db, cache_size=LOGIN_SKETCH_CACHE_SIZE):
+        self.db = db
+        self.cache_size = cache_size
+        self.sketches = OrderedDict()
+        self._loading = {}
+        self.dirty = set()
+        # Login _ids already folded in, oldest first
+        self.counted = OrderedDict()
+        # Changed sketches pushed out of the cache before they were written
+        self.evicted = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.bootstraps = 0
+        self.duplicates = 0
+        self.written = 0
+        self.failures = 0
+        metrics.register("login_sketches", self.stats)
+
+    def start(self):
+        asyncio.create_task(self._flush_loop())
+
+    async def get(self, username, before=None):
+        """Return the sketch for username, loading or building it if needed.
+
+        A sketch built from history only covers logins with an _id below
+        before, so the login being observed isn't counted twice.
+        """
+        sketch = self.sketches.get(username)
+        if sketch is not None:
+            self.hits += 1
+            self.sketches.move_to_end(username)
+            return sketch
+
+        # Concurrent callers share a single load
+        loading = self._loading.get(username)
+        if loading is None:
+            self.misses += 1
+            loading = self._loading[username] = asyncio.ensure_future(self._load(username, before))
+            loading.add_done_callback(lambda _: self._loading.pop(username, None))
+        return await asyncio.shield(loading)
+
+    async def observe(self, login_doc):
+        """Fold a login document into its user's sketch and return the sketch"""
+        username = login_doc.get('username')
+        if not username:
+            return None
+        login_id = login_doc.get('_id')
+        sketch = await self.get(username, before=login_id)
+        if login_id is not None:
+            if login_id in self.counted:
+                self.duplicates += 1
+                return sketch
+            self.counted[login_id] = True
+            if len(self.counted) > RECENT_LOGINS:
+                self.counted.popitem(last=False)
+        today = day_number(datetime.utcnow())
+        timestamp = login_doc.get('timestamp')
+        day = min(day_number(timestamp), today) if timestamp else today
+        sketch.add(hwid=login_doc.get('hwid'), ip=login_doc.get('ip_address'), day=day)
+        self.dirty.add(username)
+        return sketch
+
+    async def _load(self, username, before=None):
+        sketch = self.evicted.get(username)
+        if sketch is None:
+            document = await self.db.login_sketches.find_one({'_id': username})
+            if document is not None:
+                sketch = UserSketch.from_document(document)
+            else:
+                sketch = await self._bootstrap(username, before)
+                self.dirty.add(username)
+
+        self.sketches[username] = sketch
+        while len(self.sketches) > self.cache_size:
+            evicted_name, evicted = self.sketches.popitem(last=False)
+            if evicted_name in self.dirty:
+                self.evicted[evicted_name] = evicted
+        return sketch
+
+    async def _bootstrap(self, username, before=None):
+        self.bootstraps += 1
+        sketch = UserSketch()
+        since = datetime.utcnow() - timedelta(days=MAX_HORIZON)
+        match = {'username': username, 'timestamp': {'$gte': since}}
+        if before is not None:
+            # Logins from this one on are folded in as they are observed
+            match['_id'] = {'$lt': before}
+        pipeline = [
+            {'$match': match},
+            {'$facet': {
+                'ips': [{'$group': {'_id': '$ip_address', 'last_seen': {'$max': '$timestamp'}, 'logins': {'$sum': 1}}}],
+                'hwids': [{'$group': {'_id': '$hwid', 'last_seen': {'$max': '$timestamp'}}}]
+            }}
+        ]
+        async for row in self.db.login_logs.aggregate(pipeline):
+            # Only the last day a value was seen matters to the sliding counts
+            for ip in row['ips']:
+                if ip['_id']:
+                    sketch.add(ip=ip['_id'], day=day_number(ip['last_seen']), count=ip['logins'])
+            for hwid in row['hwids']:
+                if hwid['_id']:
+                    sketch.add(hwid=hwid['_id'], day=day_number(hwid['last_seen']))
+        return sketch
+
+    async def flush(self):
+        names = list(self.dirty)[:LOGIN_SKETCH_BATCH_SIZE]
+        if not names:
+            return
+        requests = []
+        for username in names:
+            sketch = self.sketches.get(username) or self.evicted.get(username)
+            if sketch is not None:
+                requests.append(UpdateOne({'_id': username}, {'$set': sketch.to_document()}, upsert=True))
+        self.dirty.difference_update(names)
+        try:
+            if requests:
+                await self.db.login_sketches.bulk_write(requests, ordered=False)
+        except Exception:
+            self.failures += 1
+            self.dirty.update(names)
+            raise
+        for username in names:
+            if username not in self.dirty:
+                self.evicted.pop(username, None)
+        self.written += len(requests)
+
+    async def flush_all(self):
+        while self.dirty:
+            await self.flush()
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(LOGIN_SKETCH_FLUSH_INTERVAL)
+            try:
+                await self.flush_all()
+            except Exception as e:
+                logger.error(f"Error writing login sketches: {e}")
+
+    def stats(self):
+        return {
+            "sketches": len(self.sketches),
+            "cache_size": self.cache_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "bootstraps": self.bootstraps,
+            "duplicates": self.duplicates,
+            "dirty": len(self.dirty),
+            "evicted_unwritten": len(self.evicted),
+            "written": self.written,
+            "failures": self.failures
+        }
@@ -0,0 +1,65 @@
+import time
+import logging
+from collections import deque
+
+logger = logging.getLogger('metrics')
+
+# name -> callable returning a JSON-serialisable dict
+_providers = {}
+
+
+def register(name, provider):
+    """Expose a service's stats on the keep-alive /metrics endpoint"""
+    _providers[name] = provider
+
+
+def unregister(name):
+    _providers.pop(name, None)
+
+
+def get(name):
+    """Current stats of one registered service, or None"""
+    provider = _providers.get(name)
+    if provider is None:
+        return None
+    try:
+        return provider()
+    except Exception as e:
+        logger.error(f"Error collecting metrics for {name}: {e}")
+        return None
+
+
+def snapshot():
+    """Collect the current stats of every registered service"""
+    result = {}
+    for name, provider in list(_providers.items()):
+        try:
+            result[name] = provider()
+        except Exception as e:
+            logger.error(f"Error collecting metrics for {name}: {e}")
+    return result
+
+
+class RateMeter:
+    """Events per second over a sliding window of one-second buckets"""
+
+    def __init__(self, window=60):
+        self.window = window
+        self._buckets = deque()
+
+    def mark(self, count=1):
+        now = int(time.monotonic())
+        if self._buckets and self._buckets[-1][0] == now:
+            self._buckets[-1][1] += count
+        else:
+            self._buckets.append([now, count])
+        self._expire(now)
+
+    def rate(self):
+        now = int(time.monotonic())
+        self._expire(now)
+        return sum(count for _, count in self._buckets) / self.window
+
+    def _expire(self, now):
+        while self._buckets and self._buckets[0][0] <= now - self.window:
+            self._buckets.popleft()
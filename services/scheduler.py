@@ -0,0 +1,81 @@
+import asyncio
+import heapq
+import itertools
+import logging
+from datetime import datetime
+
+logger = logging.getLogger('scheduler')
+
+# Upper bound on a single sleep so wall-clock adjustments are picked up
+MAX_SLEEP_SECONDS = 3600
+
+
+class DeadlineScheduler:
+    """Min-heap of deadlines that calls handler(key, payload) as each falls due.
+
+    Every key owns a set of entries; rescheduling or cancelling a key bumps
+    its version so stale heap entries are skipped lazily instead of searched
+    for and removed.
+    """
+
+    def __init__(self, handler, name='scheduler'):
+        self.handler = handler
+        self.name = name
+        self._heap = []
+        self._versions = {}
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+
+    def __len__(self):
+        return len(self._versions)
+
+    def schedule(self, key, entries):
+        """Replace key's pending entries with [(due_at, payload), ...]"""
+        version = self._versions.get(key, 0) + 1
+        self._versions[key] = version
+        for due_at, payload in entries:
+            heapq.heappush(self._heap, (due_at, next(self._counter), key, version, payload))
+        self._compact()
+        self._wakeup.set()
+
+    def cancel(self, key):
+        self._versions.pop(key, None)
+
+    def next_due(self):
+        """Deadline of the earliest live entry, or None"""
+        self._drop_stale()
+        return self._heap[0][0] if self._heap else None
+
+    async def run(self):
+        while True:
+            self._wakeup.clear()
+            due_at = self.next_due()
+            if due_at is None:
+                await self._wakeup.wait()
+                continue
+
+            delay = (due_at - datetime.utcnow()).total_seconds()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=min(delay, MAX_SLEEP_SECONDS))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _, _, key, version, payload = heapq.heappop(self._heap)
+            if self._versions.get(key) != version:
+                continue
+            try:
+                await self.handler(key, payload)
+            except Exception as e:
+                logger.error(f"Error in {self.name} handler for {key}: {e}")
+
+    def _drop_stale(self):
+        while self._heap and self._versions.get(self._heap[0][2]) != self._heap[0][3]:
+            heapq.heappop(self._heap)
+
+    def _compact(self):
+        # Rebuild once stale entries clearly outnumber live ones
+        if len(self._heap) > 4 * len(self._versions) + 1024:
+            self._heap = [entry for entry in self._heap if self._versions.get(entry[2]) == entry[3]]
+            heapq.heapify(self._heap)
@@ -0,0 +1,260 @@
+import ipaddress
+import logging
+import os
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+
+from services import metrics
+
+logger = logging.getLogger('sharing')
+
+# Rules are "window:threshold" pairs: alert once a key has been used by at
+# least threshold different accounts within the window (s/m/h/d suffixes)
+SHARING_HWID_RULES = os.getenv('SHARING_HWID_RULES', '1h:3,24h:5')
+SHARING_IP_RULES = os.getenv('SHARING_IP_RULES', '10m:4,24h:10')
+SHARING_SUBNET_RULES = os.getenv('SHARING_SUBNET_RULES', '10m:8,1h:15')
+# Windows slide one bucket at a time
+SHARING_BUCKET_SECONDS = int(os.getenv('SHARING_BUCKET_SECONDS', 60))
+SHARING_MAX_KEYS = int(os.getenv('SHARING_MAX_KEYS', 100000))
+# Accounts remembered per key and window; counts saturate here
+SHARING_MAX_ACCOUNTS = int(os.getenv('SHARING_MAX_ACCOUNTS', 500))
+SHARING_ALERT_COOLDOWN = int(os.getenv('SHARING_ALERT_COOLDOWN', 3600))
+
+EPOCH = datetime(1970, 1, 1)
+UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+SharingAlert = namedtuple('SharingAlert', ['kind', 'key', 'window', 'count', 'threshold', 'accounts'])
+
+
+def parse_rules(text):
+    """Parse "10m:4,24h:10" into [(window seconds, threshold)], shortest window first"""
+    rules = []
+    for part in text.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        window, threshold = part.split(':')
+        window = window.strip()
+        if window[-1] in UNITS:
+            seconds = int(window[:-1]) * UNITS[window[-1]]
+        else:
+            seconds = int(window)
+        rules.append((seconds, int(threshold)))
+    return sorted(rules)
+
+
+def format_window(seconds):
+    for unit, size in (('d', 86400), ('h', 3600), ('m', 60)):
+        if seconds >= size and seconds % size == 0:
+            return f"{seconds // size}{unit}"
+    return f"{seconds}s"
+
+
+def subnet(ip):
+    """The /24 an IPv4 address belongs to (/64 for IPv6), or None if ip isn't an address"""
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return None
+    if address.version == 4:
+        return str(address).rsplit('.', 1)[0] + '.0/24'
+    return str(ipaddress.ip_network(f"{address}/64", strict=False))
+
+
+class WindowedAccounts:
+    """Distinct accounts seen for one key, kept once per window.
+
+    Each window is an OrderedDict of username -> bucket last seen in, kept
+    in bucket order whatever order logins arrive in, so expiry pops from the
+    front. A login in the newest bucket just goes to the end; a late one is
+    slotted in before the few entries newer than it.
+    """
+
+    __slots__ = ('windows', 'last_bucket')
+
+    def __init__(self, windows):
+        self.windows = [OrderedDict() for _ in range(windows)]
+        self.last_bucket = 0
+
+    def add(self, username, bucket, latest, spans):
+        """Record a login in its bucket and return the distinct account count per window.
+
+        Windows end at latest, the newest bucket seen so far; a login older
+        than a window's start isn't counted in it.
+        """
+        self.last_bucket = max(self.last_bucket, bucket)
+        counts = []
+        for seen, span in zip(self.windows, spans):
+            cutoff = latest - span
+            if bucket > cutoff and seen.get(username, cutoff) <= bucket:
+                self._insert(seen, username, bucket)
+            self._expire(seen, cutoff)
+            counts.append(len(seen))
+        return counts
+
+    @staticmethod
+    def _insert(seen, username, bucket):
+        seen.pop(username, None)
+        newer = []
+        for other, other_bucket in reversed(seen.items()):
+            if other_bucket <= bucket:
+                break
+            newer.append(other)
+        seen[username] = bucket
+        for other in reversed(newer):
+            seen.move_to_end(other)
+
+    @staticmethod
+    def _expire(seen, cutoff):
+        while seen:
+            oldest = next(iter(seen.values()))
+            if oldest > cutoff and len(seen) <= SHARING_MAX_ACCOUNTS:
+                break
+            seen.popitem(last=False)
+
+    def accounts(self, window, limit=10):
+        """Most recent accounts first"""
+        seen = self.windows[window]
+        return [username for username, _ in zip(reversed(seen), range(limit))]
+
+
+class SharingDetector:
+    """Spots one HWID, IP or /24 subnet logging into many accounts at once.
+
+    Fed every login from the change stream; each update touches only the
+    login's own keys, so it is O(1) per window and needs no database query.
+    Time is cut into SHARING_BUCKET_SECONDS buckets, each login goes in the
+    bucket of its own timestamp, and every window keeps the accounts seen in
+    its last span of buckets up to the newest bucket seen, so a backlog
+    replayed after downtime is spread over the time it really covered. Keys
+    untouched for the longest window are dropped, oldest first, and at most
+    SHARING_MAX_KEYS are kept per kind, so memory stays bounded. A key that crosses a rule's
+    threshold alerts at most once per SHARING_ALERT_COOLDOWN seconds.
+    """
+
+    def __init__(self, bucket_seconds=SHARING_BUCKET_SECONDS, max_keys=SHARING_MAX_KEYS,
+                 cooldown=SHARING_ALERT_COOLDOWN):
+        self.bucket_seconds = bucket_seconds
+        self.max_keys = max_keys
+        self.cooldown = cooldown
+        # kind -> [(window seconds, threshold)]
+        self.rules = {
+            'hwid': parse_rules(SHARING_HWID_RULES),
+            'ip': parse_rules(SHARING_IP_RULES),
+            'subnet': parse_rules(SHARING_SUBNET_RULES),
+        }
+        # kind -> window spans in buckets, parallel to the rules
+        self.spans = {
+            kind: [max(1, -(-seconds // bucket_seconds)) for seconds, _ in rules]
+            for kind, rules in self.rules.items()
+        }
+        self.longest = max((seconds for rules in self.rules.values() for seconds, _ in rules), default=0)
+        # kind -> key -> WindowedAccounts, least recently used first
+        self.keys = {kind: OrderedDict() for kind in self.rules}
+        # (kind, key) -> bucket of the last alert, oldest first
+        self.alerted = OrderedDict()
+        # Newest bucket any login has fallen in; windows and expiry end here
+        self.latest = 0
+
+        self.updates = 0
+        self.stale = 0
+        self.alerts = 0
+        self.suppressed = 0
+        self.expired = 0
+        self.evicted = 0
+        metrics.register("sharing", self.stats)
+
+    def bucket(self, when):
+        return int((when - EPOCH).total_seconds()) // self.bucket_seconds
+
+    def observe(self, username, hwid=None, ip=None, timestamp=None):
+        """Fold one login in; return a SharingAlert for every rule it newly trips"""
+        if not username:
+            return []
+        now = datetime.utcnow()
+        # Logins older than every window (e.g. replayed dead letters) can't
+        # tell us anything about sharing happening now
+        if timestamp is not None and (now - timestamp).total_seconds() > self.longest:
+            self.stale += 1
+            return []
+        self.updates += 1
+        bucket = self.bucket(min(timestamp, now) if timestamp is not None else now)
+        self.latest = max(self.latest, bucket)
+
+        keys = [('hwid', hwid), ('ip', ip)]
+        if ip:
+            keys.append(('subnet', subnet(ip)))
+
+        alerts = []
+        for kind, key in keys:
+            rules = self.rules[kind]
+            if not key or not rules:
+                continue
+            entries = self.keys[kind]
+            entry = entries.get(key)
+            if entry is None:
+                entry = entries[key] = WindowedAccounts(len(rules))
+            else:
+                entries.move_to_end(key)
+            counts = entry.add(username, bucket, self.latest, self.spans[kind])
+
+            for index, ((seconds, threshold), count) in enumerate(zip(rules, counts)):
+                if count >= threshold:
+                    if self._claim(kind, key, bucket):
+                        alerts.append(SharingAlert(kind, key, seconds, count, threshold, entry.accounts(index)))
+                    else:
+                        self.suppressed += 1
+                    # One alert per key covers all of its windows
+                    break
+
+        self._expire(self.latest)
+        return alerts
+
+    def _claim(self, kind, key, bucket):
+        """True if (kind, key) hasn't alerted within the cooldown, recording that it now has"""
+        last = self.alerted.get((kind, key))
+        if last is not None and (bucket - last) * self.bucket_seconds < self.cooldown:
+            return False
+        self.alerted[(kind, key)] = bucket
+        self.alerted.move_to_end((kind, key))
+        self.alerts += 1
+        return True
+
+    def release(self, alert):
+        """Forget an alert's cooldown claim, for when it couldn't be delivered"""
+        if self.alerted.pop((alert.kind, alert.key), None) is not None:
+            self.alerts -= 1
+
+    def _expire(self, bucket):
+        cutoff = bucket - -(-self.longest // self.bucket_seconds)
+        for entries in self.keys.values():
+            while entries:
+                oldest = next(iter(entries.values()))
+                if oldest.last_bucket > cutoff:
+                    break
+                entries.popitem(last=False)
+                self.expired += 1
+            while len(entries) > self.max_keys:
+                entries.popitem(last=False)
+                self.evicted += 1
+
+        cooldown_cutoff = bucket - -(-self.cooldown // self.bucket_seconds)
+        while self.alerted:
+            if next(iter(self.alerted.values())) > cooldown_cutoff:
+                break
+            self.alerted.popitem(last=False)
+
+    def stats(self):
+        return {
+            "keys": {kind: len(entries) for kind, entries in self.keys.items()},
+            "rules": {
+                kind: [f"{format_window(seconds)}:{threshold}" for seconds, threshold in rules]
+                for kind, rules in self.rules.items()
+            },
+            "updates": self.updates,
+            "stale": self.stale,
+            "alerts": self.alerts,
+            "suppressed": self.suppressed,
+            "expired": self.expired,
+            "evicted": self.evicted
+        }
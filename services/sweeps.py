@@ -0,0 +1,54 @@
+import os
+
+SWEEP_BATCH_SIZE = int(os.getenv('SWEEP_BATCH_SIZE', 1000))
+# How many users a sweep digest lists by name
+DIGEST_LIMIT = 20
+
+
+async def bulk_transition(collection, query, update, projection, batch_size=SWEEP_BATCH_SIZE):
+    """Apply update to every document matching query, one bounded batch at a time.
+
+    The predicate runs on the server; each batch is fetched with only the
+    projected fields and flipped with a single update_many that re-checks the
+    predicate, so documents changed in between are left alone. Yields, per
+    batch, the documents that were transitioned. update must be a $set.
+    """
+    while True:
+        batch = await collection.find(query, projection).limit(batch_size).to_list(length=batch_size)
+        if not batch:
+            return
+
+        ids = [doc["_id"] for doc in batch]
+        result = await collection.update_many({"$and": [{"_id": {"$in": ids}}, query]}, update)
+        if 0 < result.modified_count < len(batch):
+            # Some changed in between; report only those now in the new state
+            transitioned = await collection.find(
+                {"_id": {"$in": ids}, **update["$set"]}, {"_id": 1}
+            ).to_list(length=len(ids))
+            transitioned = {doc["_id"] for doc in transitioned}
+            batch = [doc for doc in batch if doc["_id"] in transitioned]
+        if result.modified_count > 0:
+            yield batch
+
+        # Nothing changed means the remaining matches can't be transitioned
+        if result.modified_count == 0:
+            return
+
+
+class SweepDigest:
+    """Running total plus the first few documents of a sweep, for one summary alert"""
+
+    def __init__(self, limit=DIGEST_LIMIT):
+        self.limit = limit
+        self.total = 0
+        self.sample = []
+
+    def add(self, docs):
+        self.total += len(docs)
+        self.sample.extend(docs[:self.limit - len(self.sample)])
+
+    def lines(self, format_doc):
+        lines = [format_doc(doc) for doc in self.sample]
+        if self.total > len(self.sample):
+            lines.append(f"... and {self.total - len(self.sample)} more")
+        return "\n".join(lines)
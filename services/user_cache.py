@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from services import metrics
+
+logger = logging.getLogger('user_cache')
+
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 300))
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10000))
+
+
+class UserCache:
+    """Bounded read-through cache of user documents keyed by username.
+
+    Entries expire after USER_CACHE_TTL seconds and the least recently used
+    are evicted past USER_CACHE_SIZE. Unknown usernames are cached too, so
+    repeated lookups for unregistered members stay off the database. Entries
+    are dropped as soon as the users change stream or one of the bot's own
+    writes touches them.
+    """
+
+    def __init__(self, db, change_streams, ttl=USER_CACHE_TTL, max_size=USER_CACHE_SIZE):
+        self.db = db
+        self.ttl = ttl
+        self.max_size = max_size
+        # username -> (expires_at, user document or None)
+        self.entries = OrderedDict()
+        # _id -> username of cached documents, so deletes can be matched
+        self._usernames = {}
+        # Bumped on every invalidation so in-flight reads can't store stale data
+        self._version = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+        self.change_stream = change_streams.subscribe(
+            'users',
+            name='user_cache',
+            operation_types=['insert', 'update', 'replace', 'delete'],
+            fields=['username'],
+            full_document=True
+        )
+        metrics.register("user_cache", self.stats)
+
+    def start(self):
+        asyncio.create_task(self._watch_users())
+
+    def cached(self, username):
+        """(True, user) if username is cached and fresh, else (False, None); never queries"""
+        entry = self.entries.get(username)
+        if entry is not None:
+            expires_at, user = entry
+            if expires_at > time.monotonic():
+                self.hits += 1
+                self.entries.move_to_end(username)
+                return True, user
+            self._remove(username)
+        return False, None
+
+    async def get(self, username):
+        """Return the user document for username, or None if there is none"""
+        hit, user = self.cached(username)
+        if hit:
+            return user
+
+        self.misses += 1
+        version = self._version
+        user = await self.db.users.find_one({"username": username})
+        if version == self._version:
+            self._store(username, user)
+        return user
+
+    def invalidate(self, username):
+        """Drop a cached user, e.g. after the bot writes to it"""
+        self._version += 1
+        if username in self.entries:
+            self.invalidations += 1
+            self._remove(username)
+
+    def _store(self, username, user):
+        self.entries[username] = (time.monotonic() + self.ttl, user)
+        self.entries.move_to_end(username)
+        if user is not None:
+            self._usernames[user['_id']] = username
+        while len(self.entries) > self.max_size:
+            _, entry = self.entries.popitem(last=False)
+            self._forget(entry)
+            self.evictions += 1
+
+    def _remove(self, username):
+        entry = self.entries.pop(username, None)
+        if entry is not None:
+            self._forget(entry)
+
+    def _forget(self, entry):
+        _, user = entry
+        if user is not None:
+            self._usernames.pop(user['_id'], None)
+
+    async def _watch_users(self):
+        while True:
+            try:
+                change = await self.change_stream.get()
+                user_id = change['documentKey']['_id']
+                # Drop both the old and (after a rename) the new username
+                if user_id in self._usernames:
+                    self.invalidate(self._usernames[user_id])
+                username = (change.get('fullDocument') or {}).get('username')
+                if username:
+                    self.invalidate(username)
+            except Exception as e:
+                logger.error(f"Error in user cache watcher: {e}")
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations
+        }
@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import os
+from datetime import datetime
+
+from services import metrics
+
+logger = logging.getLogger('user_stats')
+
+USER_STATUSES = ('active', 'banned', 'expired', 'inactive')
+RECONCILE_INTERVAL = int(os.getenv('USER_STATS_RECONCILE_INTERVAL', 900))
+# Delay before reconciling after a change whose previous status is unknown
+RECONCILE_DEBOUNCE = 5
+# How long get() waits for the first reconcile before giving up
+USER_STATS_READY_TIMEOUT = float(os.getenv('USER_STATS_READY_TIMEOUT', 10))
+
+
+class UserStats:
+    """Materialised user counts by status, kept current from the users change stream.
+
+    Inserts are counted directly. Status changes and deletes don't carry the
+    previous status, so they trigger a debounced reconcile: one $facet
+    aggregation that recounts everything. A periodic reconcile corrects any
+    remaining drift. Each reconcile records the cluster time before and after
+    it runs: inserts from before are already in its result and are skipped
+    (e.g. a backlog replayed from the checkpoint after a restart), and ones
+    during it may or may not be, so they trigger another reconcile.
+    """
+
+    def __init__(self, db, change_streams):
+        self.db = db
+        self.counts = None
+        self.updated_at = None
+        self._ready = asyncio.Event()
+        self._dirty = asyncio.Event()
+        self._reconciling = False
+        # Cluster times bracketing the last reconcile's aggregation
+        self.reconcile_started = None
+        self.reconcile_finished = None
+
+        self.change_stream = change_streams.subscribe(
+            'users',
+            name='user_stats',
+            operation_types=['insert', 'update', 'replace', 'delete'],
+            fields=['status']
+        )
+        metrics.register("users", self.snapshot)
+
+    def start(self):
+        asyncio.create_task(self._watch_users())
+        asyncio.create_task(self._reconcile_loop())
+
+    async def get(self):
+        """Wait for the first reconcile, then return the current snapshot"""
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout=USER_STATS_READY_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise RuntimeError("User counts are not available yet") from None
+        return self.snapshot()
+
+    def snapshot(self):
+        if self.counts is None:
+            return None
+        snapshot = dict(self.counts)
+        snapshot['updated_at'] = self.updated_at.isoformat()
+        return snapshot
+
+    async def reconcile(self):
+        """Recount every status with a single aggregation"""
+        self._reconciling = True
+        try:
+            started = await self.cluster_time()
+            pipeline = [{'$facet': {
+                'total': [{'$count': 'count'}],
+                'by_status': [{'$group': {'_id': '$status', 'count': {'$sum': 1}}}]
+            }}]
+            result = await self.db.users.aggregate(pipeline).to_list(length=1)
+            finished = await self.cluster_time()
+        finally:
+            self._reconciling = False
+
+        facets = result[0] if result else {'total': [], 'by_status': []}
+        counts = {status: 0 for status in USER_STATUSES}
+        counts['total'] = facets['total'][0]['count'] if facets['total'] else 0
+        for row in facets['by_status']:
+            if row['_id'] in counts and row['_id'] != 'total':
+                counts[row['_id']] = row['count']
+
+        self.counts = counts
+        self.reconcile_started = started
+        self.reconcile_finished = finished
+        self.updated_at = datetime.utcnow()
+        self._ready.set()
+
+    async def cluster_time(self):
+        """The deployment's current operation time, or None where it isn't reported"""
+        reply = await self.db.command('ping')
+        return reply.get('operationTime')
+
+    async def _reconcile_loop(self):
+        while True:
+            self._dirty.clear()
+            try:
+                await self.reconcile()
+            except Exception as e:
+                logger.error(f"Error reconciling user stats: {e}")
+
+            try:
+                await asyncio.wait_for(self._dirty.wait(), timeout=RECONCILE_INTERVAL)
+                await asyncio.sleep(RECONCILE_DEBOUNCE)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _watch_users(self):
+        while True:
+            try:
+                change = await self.change_stream.get()
+                self._apply(change)
+            except Exception as e:
+                logger.error(f"Error in user stats watcher: {e}")
+
+    def _apply(self, change):
+        operation = change['operationType']
+        if operation == 'update':
+            updated = change.get('updateDescription', {})
+            if 'status' not in updated.get('updatedFields', {}) and 'status' not in updated.get('removedFields', []):
+                return
+
+        # Changes made mid-aggregation may or may not be in its result,
+        # so they are settled by another reconcile rather than counted
+        if operation == 'insert' and self.counts is not None and not self._reconciling:
+            cluster_time = change.get('clusterTime')
+            if cluster_time is not None and self.reconcile_started is not None:
+                if cluster_time <= self.reconcile_started:
+                    return
+                if self.reconcile_finished is None or cluster_time <= self.reconcile_finished:
+                    self._dirty.set()
+                    return
+            self.counts['total'] += 1
+            status = change.get('fullDocument', {}).get('status')
+            if status in USER_STATUSES:
+                self.counts[status] += 1
+            self.updated_at = datetime.utcnow()
+        else:
+            self._dirty.set()
@@ -0,0 +1,297 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+import aiohttp
+
+from services import metrics
+
+logger = logging.getLogger('vpn')
+
+PROXYCHECK_API_KEY = os.getenv('PROXYCHECK_API_KEY', '')
+# Overridable so the client can be pointed at a local stub server
+PROXYCHECK_URL = os.getenv('PROXYCHECK_URL', 'https://proxycheck.io/v2')
+VPN_REQUEST_TIMEOUT = float(os.getenv('VPN_REQUEST_TIMEOUT', 3))
+VPN_MAX_CONNECTIONS = int(os.getenv('VPN_MAX_CONNECTIONS', 20))
+VPN_CACHE_SIZE = int(os.getenv('VPN_CACHE_SIZE', 50000))
+# A VPN verdict is trusted longer than a clean one
+VPN_POSITIVE_TTL = int(os.getenv('VPN_POSITIVE_TTL', 24 * 3600))
+VPN_NEGATIVE_TTL = int(os.getenv('VPN_NEGATIVE_TTL', 6 * 3600))
+VPN_RATE_LIMIT = float(os.getenv('VPN_RATE_LIMIT', 5))
+VPN_DAILY_QUOTA = int(os.getenv('VPN_DAILY_QUOTA', 1000))
+# Addresses are collected for up to this many seconds, or until the batch
+# is full, and then checked in one request
+VPN_BATCH_WINDOW = float(os.getenv('VPN_BATCH_WINDOW', 0.05))
+VPN_BATCH_SIZE = int(os.getenv('VPN_BATCH_SIZE', 100))
+
+
+class RateLimiter:
+    """Token bucket of `rate` requests per second, under a daily quota.
+
+    The quota counts addresses checked, not requests, and resets at
+    midnight UTC, like proxycheck.io's. The provider can also cut it short
+    with exhaust(), e.g. after a "denied" response.
+    """
+
+    def __init__(self, rate=VPN_RATE_LIMIT, daily_quota=VPN_DAILY_QUOTA):
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.daily_quota = daily_quota
+        self.day = datetime.utcnow().date()
+        self.used = 0
+        self.exhausted = False
+
+    def _roll_day(self):
+        today = datetime.utcnow().date()
+        if today != self.day:
+            self.day = today
+            self.used = 0
+            self.exhausted = False
+
+    def remaining(self):
+        self._roll_day()
+        if self.exhausted:
+            return 0
+        return max(0, self.daily_quota - self.used)
+
+    def exhaust(self):
+        self.exhausted = True
+
+    async def acquire(self, deadline, addresses=1):
+        """Take one request checking up to `addresses` IPs, waiting no later
+        than deadline (monotonic); return how many of them the quota allows
+        """
+        while True:
+            allowed = min(addresses, self.remaining())
+            if not allowed:
+                return 0
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                self.used += allowed
+                return allowed
+            wait = (1 - self.tokens) / self.rate
+            if now + wait > deadline:
+                return 0
+            await asyncio.sleep(wait)
+
+
+class VPNClient:
+    """Asynchronous VPN/proxy verdicts from proxycheck.io.
+
+    Requests share one pooled aiohttp session. Concurrent checks of the
+    same address share a single in-flight lookup, and lookups of different
+    addresses are micro-batched: they wait up to batch_window seconds, or
+    until batch_size are waiting, and go out as one multi-IP POST whose
+    response resolves each of them. A lookup's VPN_REQUEST_TIMEOUT deadline
+    runs from when it joined the batch. Verdicts are cached per address,
+    VPN ones for VPN_POSITIVE_TTL and clean ones for VPN_NEGATIVE_TTL.
+    check() returns None, uncached, when no verdict could be had: a
+    timeout, an error, or no rate-limit or quota budget left.
+    """
+
+    def __init__(self, base_url=PROXYCHECK_URL, api_key=PROXYCHECK_API_KEY, timeout=VPN_REQUEST_TIMEOUT,
+                 limiter=None, cache_size=VPN_CACHE_SIZE, batch_window=VPN_BATCH_WINDOW,
+                 batch_size=VPN_BATCH_SIZE):
+        self.base_url = base_url.rstrip('/')
+        self.api_key = api_key
+        self.timeout = timeout
+        self.limiter = limiter or RateLimiter()
+        self.cache_size = cache_size
+        self.session = None
+        # ip -> (expires_at, verdict), least recently used first
+        self.cache = OrderedDict()
+        # ip -> task fetching its verdict
+        self.inflight = {}
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        # ip -> (future, enqueued_at) waiting for the next batch
+        self.batch = {}
+        self._flush_handle = None
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.requests = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.throttled = 0
+        self.batches = 0
+        self.batched_ips = 0
+        self.max_batch = 0
+        # Time lookups spent waiting for their batch to go out
+        self.window_wait = 0.0
+        self.max_window_wait = 0.0
+        metrics.register("vpn", self.stats)
+
+    def _session(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=VPN_MAX_CONNECTIONS, ttl_dns_cache=300),
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        return self.session
+
+    def cached(self, ip):
+        """(True, verdict) for a live cache entry, else (False, None)"""
+        entry = self.cache.get(ip)
+        if entry is None:
+            return False, None
+        expires_at, verdict = entry
+        if expires_at <= time.monotonic():
+            del self.cache[ip]
+            return False, None
+        self.cache.move_to_end(ip)
+        return True, verdict
+
+    def store(self, ip, verdict):
+        ttl = VPN_POSITIVE_TTL if verdict else VPN_NEGATIVE_TTL
+        self.cache[ip] = (time.monotonic() + ttl, verdict)
+        self.cache.move_to_end(ip)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    async def check(self, ip):
+        """True if ip is a VPN or proxy, False if not, None if unknown"""
+        found, verdict = self.cached(ip)
+        if found:
+            self.hits += 1
+            return verdict
+        self.misses += 1
+
+        task = self.inflight.get(ip)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(ip))
+            self.inflight[ip] = task
+            task.add_done_callback(lambda _: self.inflight.pop(ip, None))
+        else:
+            self.coalesced += 1
+        # One caller being cancelled mustn't cancel the others' request
+        return await asyncio.shield(task)
+
+    async def _fetch(self, ip):
+        """Queue ip for the next batch and wait for its verdict"""
+        future = asyncio.get_running_loop().create_future()
+        self.batch[ip] = (future, time.monotonic())
+        if len(self.batch) >= self.batch_size:
+            self._flush_batch()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.batch_window, self._flush_batch)
+        return await future
+
+    def _flush_batch(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self.batch = self.batch, {}
+        if batch:
+            asyncio.ensure_future(self._send_batch(batch))
+
+    async def _send_batch(self, batch):
+        now = time.monotonic()
+        self.batches += 1
+        self.batched_ips += len(batch)
+        self.max_batch = max(self.max_batch, len(batch))
+        for _, enqueued_at in batch.values():
+            self.window_wait += now - enqueued_at
+            self.max_window_wait = max(self.max_window_wait, now - enqueued_at)
+
+        verdicts = {}
+        try:
+            verdicts = await self._request(list(batch), min(enqueued_at for _, enqueued_at in batch.values()))
+        finally:
+            for ip, (future, _) in batch.items():
+                if not future.done():
+                    future.set_result(verdicts.get(ip))
+
+    async def _request(self, ips, enqueued_at):
+        """One multi-IP POST; ip -> verdict for the addresses that got one"""
+        deadline = enqueued_at + self.timeout
+        allowed = await self.limiter.acquire(deadline, len(ips))
+        if allowed < len(ips):
+            self.throttled += len(ips) - allowed
+            ips = ips[:allowed]
+        if not ips:
+            return {}
+
+        self.requests += 1
+        params = {'vpn': 1}
+        if self.api_key:
+            params['key'] = self.api_key
+        try:
+            remaining = max(0.0, deadline - time.monotonic())
+            async with self._session().post(
+                f"{self.base_url}/",
+                params=params,
+                data={'ips': ','.join(ips)},
+                timeout=aiohttp.ClientTimeout(total=remaining)
+            ) as response:
+                data = await response.json(content_type=None)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            return {}
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"Error checking {len(ips)} IPs for VPN: {e}")
+            return {}
+
+        verdicts = self.parse(data, ips)
+        for ip, verdict in verdicts.items():
+            self.store(ip, verdict)
+        return verdicts
+
+    def parse(self, data, ips):
+        """ip -> verdict from a proxycheck.io response; addresses without one are left out"""
+        if not isinstance(data, dict):
+            self.errors += 1
+            return {}
+        if data.get('status') == 'denied':
+            # Out of queries (or the key was refused) until the quota resets
+            logger.warning(f"VPN provider denied the request: {data.get('message')}")
+            self.limiter.exhaust()
+            return {}
+        verdicts = {}
+        for ip in ips:
+            result = data.get(ip)
+            if isinstance(result, dict) and 'proxy' in result:
+                verdicts[ip] = result['proxy'] == 'yes'
+        return verdicts
+
+    async def close(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self.batch = self.batch, {}
+        for future, _ in batch.values():
+            if not future.done():
+                future.set_result(None)
+        if self.session is not None:
+            await self.session.close()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "cache_size": len(self.cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "coalesced": self.coalesced,
+            "inflight": len(self.inflight),
+            "requests": self.requests,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "throttled": self.throttled,
+            "quota_remaining": self.limiter.remaining(),
+            "batches": self.batches,
+            "avg_batch_size": round(self.batched_ips / self.batches, 2) if self.batches else 0.0,
+            "max_batch_size": self.max_batch,
+            "avg_window_wait_ms": round(self.window_wait / self.batched_ips * 1000, 2) if self.batched_ips else 0.0,
+            "max_window_wait_ms": round(self.max_window_wait * 1000, 2)
+        }
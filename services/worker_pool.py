@@ -0,0 +1,123 @@
+import asyncio
+import logging
+import os
+import time
+import zlib
+from collections import deque
+
+from services import metrics
+
+logger = logging.getLogger('worker_pool')
+
+LOGIN_WORKERS = int(os.getenv('LOGIN_WORKERS', 8))
+LOGIN_WORKER_QUEUE_SIZE = int(os.getenv('LOGIN_WORKER_QUEUE_SIZE', 1000))
+# Seconds a closing pool waits for queued events before cancelling its workers
+LOGIN_WORKER_DRAIN_TIMEOUT = float(os.getenv('LOGIN_WORKER_DRAIN_TIMEOUT', 10))
+
+
+def partition(key, partitions):
+    """Stable partition of a key; crc32 rather than hash(), which is salted per process"""
+    return zlib.crc32(str(key).encode()) % partitions
+
+
+class KeyedWorkerPool:
+    """Runs a handler over events concurrently while keeping per-key order.
+
+    Each of the N workers owns a bounded queue, and an event goes to the
+    queue its key hashes to, so all events for one key are handled one
+    after another by the same worker while different keys proceed in
+    parallel. submit() waits when that queue is full, pushing back on the
+    change stream rather than buffering without limit. The time events wait
+    in their queue before a worker picks them up is recorded per partition,
+    to show head-of-line blocking behind a slow event.
+    """
+
+    def __init__(self, name, handler, workers=LOGIN_WORKERS, queue_size=LOGIN_WORKER_QUEUE_SIZE):
+        self.name = name
+        self.handler = handler
+        self.queues = [asyncio.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.tasks = []
+        # Per partition: recent queue waits (seconds) and the longest seen
+        self.waits = [deque(maxlen=1000) for _ in range(workers)]
+        self.max_waits = [0.0] * workers
+        self.processed = 0
+        self.errors = 0
+        self.blocked_submits = 0
+        metrics.register(f"workers_{name}", self.stats)
+
+    def start(self):
+        if not self.tasks:
+            self.tasks = [asyncio.create_task(self._work(i)) for i in range(len(self.queues))]
+
+    async def submit(self, key, event, done=None):
+        """Queue an event behind any earlier ones with the same key.
+
+        done, if given, is called once the handler has finished with the
+        event, so the change stream checkpoint only moves past it then.
+        """
+        queue = self.queues[partition(key, len(self.queues))]
+        if queue.full():
+            self.blocked_submits += 1
+        await queue.put((time.monotonic(), event, done))
+
+    async def _work(self, index):
+        queue = self.queues[index]
+        while True:
+            enqueued_at, event, done = await queue.get()
+            wait = time.monotonic() - enqueued_at
+            self.waits[index].append(wait)
+            self.max_waits[index] = max(self.max_waits[index], wait)
+            # Acked once handled, even if that failed, but not when the
+            # worker is cancelled mid-event: that one is replayed instead
+            try:
+                try:
+                    await self.handler(event)
+                    self.processed += 1
+                except Exception as e:
+                    self.errors += 1
+                    logger.error(f"Error in {self.name} worker: {e}")
+                if done is not None:
+                    done()
+            finally:
+                queue.task_done()
+
+    async def join(self):
+        """Wait until every queued event has been handled"""
+        for queue in self.queues:
+            await queue.join()
+
+    async def drain(self, timeout=LOGIN_WORKER_DRAIN_TIMEOUT):
+        """Give queued events up to timeout seconds to be handled, then close the pool.
+
+        Events still queued or mid-handler after that are dropped
+        unacknowledged, so the change stream replays them after the restart.
+        """
+        try:
+            await asyncio.wait_for(self.join(), timeout)
+        except asyncio.TimeoutError:
+            queued = sum(queue.qsize() for queue in self.queues)
+            logger.warning(f"{self.name} pool closed with {queued} events still queued")
+        self.close()
+
+    def close(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+        metrics.unregister(f"workers_{self.name}")
+
+    def stats(self):
+        partitions = []
+        for queue, waits, max_wait in zip(self.queues, self.waits, self.max_waits):
+            partitions.append({
+                "depth": queue.qsize(),
+                "avg_wait_ms": round(sum(waits) / len(waits) * 1000, 2) if waits else 0.0,
+                "max_wait_ms": round(max_wait * 1000, 2)
+            })
+        return {
+            "workers": len(self.queues),
+            "processed": self.processed,
+            "errors": self.errors,
+            "blocked_submits": self.blocked_submits,
+            "queued": sum(queue.qsize() for queue in self.queues),
+            "partitions": partitions
+        }